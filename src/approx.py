@@ -0,0 +1,89 @@
+import stats
+
+def lower_bounds(p, bwtMatcher):
+    """
+    The D-array of p: D[i] is a lower bound on the number of edits needed
+    to align p[:i+1], namely the number of pieces p[:i+1] has to be cut
+    into before each piece occurs in the genome. The pieces are extended to
+    the right by backward search in the index of the reversed text.
+    Without a reverse index there is no bound and D is all zeros.
+    """
+    D = [0] * len(p)
+    reverse = bwtMatcher.reverse_rank_table
+    if reverse is None:
+        return D
+    z = 0
+    n = len(bwtMatcher.f)
+    left, right = 0, n
+    for i, a in enumerate(p):
+        c = bwtMatcher.alphadic.get(a)
+        if c is not None:
+            left = bwtMatcher.C[c] + reverse.rank(c, left)
+            right = bwtMatcher.C[c] + reverse.rank(c, right)
+        if c is None or left >= right:
+            z += 1
+            left, right = 0, n
+        D[i] = z
+    return D
+
+def approximate_search(p, bwtMatcher, edits, letters):
+    """
+    Yields (left, right, cigar) for every suffix array interval whose suffixes
+    start with an alignment of p with at most the given number of edits
+    (substitutions, insertions and deletions). The search backtracks over
+    the BWT from the end of p. Alignments never start or end with an indel,
+    and never have an insertion next to a deletion, since those are the same
+    as an alignment with fewer edits.
+    """
+    if p == "":
+        return
+    occ = bwtMatcher.rank_table.rank
+    lookups = 0
+    C = bwtMatcher.C
+    D = lower_bounds(p, bwtMatcher)
+    codes = [bwtMatcher.alphadic.get(a) for a in p]
+
+    # (index of the next letter of p, edits left, left, right, operations so far in reverse)
+    stack = [(len(p) - 1, edits, 0, len(bwtMatcher.f), "")]
+    while stack:
+        i, z, left, right, ops = stack.pop()
+        if i < 0:
+            yield left, right, cigar(ops[::-1])
+            continue
+        if z < D[i]:
+            continue
+
+        last = ops[-1] if ops else ""
+        if z > 0 and ops and last != "D" and i > 0:
+            # Insertion: the letter is in the read but not in the genome
+            stack.append((i - 1, z - 1, left, right, ops + "I"))
+        lookups += 2 * len(letters)
+        for c in letters:
+            l = C[c] + occ(c, left)
+            r = C[c] + occ(c, right)
+            if l >= r:
+                continue
+            if c == codes[i]:
+                stack.append((i - 1, z, l, r, ops + "M"))
+            elif z > 0:
+                stack.append((i - 1, z - 1, l, r, ops + "M"))
+            if z > 0 and ops and last != "I":
+                # Deletion: the letter is in the genome but not in the read
+                stack.append((i, z - 1, l, r, ops + "D"))
+    stats.current.count("rank_lookups", lookups)
+
+def cigar(ops):
+    """
+    Compresses a string of edit operations into a CIGAR string
+
+    >>> cigar("MMMIMMDDM")
+    '3M1I2M2D1M'
+    """
+    out = []
+    count = 0
+    for j, op in enumerate(ops):
+        count += 1
+        if j + 1 == len(ops) or ops[j + 1] != op:
+            out.append(f"{count}{op}")
+            count = 0
+    return "".join(out)
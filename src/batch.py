@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import numpy as np
+import stats
+
+# Code of the letters that are not in the alphabet of the genome
+INVALID = 255
+DEFAULT_MEMO_LENGTH = 16
+
+class SuffixMemo:
+    """
+    Bounded memo of the suffix array intervals of the last `length` letters
+    of recently searched reads, keyed by their symbol codes. Reads ending in
+    a remembered suffix start their backward search from its interval; the
+    least recently used entries are dropped beyond maxEntries.
+
+    >>> memo = SuffixMemo(2, length=3)
+    >>> memo.put(b"abc", (1, 4)); memo.put(b"bcd", (0, 0)); memo.get(b"abc")
+    (1, 4)
+    >>> memo.put(b"cde", (2, 3)); memo.get(b"bcd") is None
+    True
+    """
+    def __init__(self, maxEntries, length=DEFAULT_MEMO_LENGTH):
+        if length < 1:
+            raise ValueError(f"the length of the memoized suffixes must be at least 1, not {length}")
+        self.maxEntries = maxEntries
+        self.length = length
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        interval = self.entries.get(key)
+        if interval is not None:
+            self.entries.move_to_end(key)
+        return interval
+
+    def put(self, key, interval):
+        self.entries[key] = interval
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+def code_table(alphadic):
+    """
+    Lookup table from byte values to symbol codes
+    """
+    table = np.full(256, INVALID, dtype=np.uint8)
+    for a, c in alphadic.items():
+        table[ord(a)] = c
+    return table
+
+def encode_reads(sequences, alphadic):
+    """
+    Encodes the reads as a uint8 matrix with one read per row, aligned to
+    the right and padded with INVALID on the left, plus the read lengths.
+
+    >>> codes, lengths = encode_reads(["ssi", "x", "is"], {"$": 0, "i": 1, "s": 2})
+    >>> codes
+    array([[  2,   2,   1],
+           [255, 255, 255],
+           [255,   1,   2]], dtype=uint8)
+    >>> lengths
+    array([3, 1, 2])
+    """
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    total = int(lengths.sum())
+    m = int(lengths.max()) if len(sequences) else 0
+    flat = code_table(alphadic)[np.frombuffer("".join(sequences).encode("ascii", errors="replace"), dtype=np.uint8)]
+
+    codes = np.full((len(sequences), m), INVALID, dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    rows = np.repeat(np.arange(len(sequences)), lengths)
+    columns = np.arange(total) - np.repeat(starts, lengths) + np.repeat(m - lengths, lengths)
+    codes[rows, columns] = flat
+    return codes, lengths
+
+def batch_search(codes, lengths, bwtMatcher, memo=None):
+    """
+    Backward search of all the reads of an encoded block at once. Every step
+    handles one column of the block for all the reads that are still active,
+    with vectorized rank lookups. Returns the left and right ends of the
+    suffix array interval of every read; reads without hits have left >= right.
+    With a SuffixMemo, reads whose last memo.length letters are remembered
+    start from that interval, and the others are remembered.
+
+    In a run-length index the suffix array value at the last row of every
+    interval (its toehold) is followed as well and returned as a third
+    array, otherwise None. The k-mer table and the memo only keep intervals,
+    so they are not used then.
+    """
+    rank_table = bwtMatcher.rank_table
+    C = np.asarray(bwtMatcher.C, dtype=np.int64)
+    nReads, m = codes.shape
+    left = np.zeros(nReads, dtype=np.int64)
+    right = np.full(nReads, len(bwtMatcher.f), dtype=np.int64)
+    right[lengths == 0] = 0
+    toehold = None
+    if bwtMatcher.f.mode == "runs":
+        samples = np.asarray(bwtMatcher.f.samples, dtype=np.int64)
+        toehold = np.full(nReads, samples[-1], dtype=np.int64)
+        memo = None
+
+    # Columns to the right of start have already been searched
+    start = np.full(nReads, m, dtype=np.int64)
+    kmerTable = bwtMatcher.kmers if toehold is None else None
+    if kmerTable is not None and m >= kmerTable.k:
+        k = kmerTable.k
+        long = np.nonzero(lengths >= k)[0]
+        left[long], right[long] = kmerTable.intervals_many(codes[long, m - k:])
+        start[long] = m - k
+
+    # Reads whose suffix starting at column is not in the memo yet, and its key
+    column = -1
+    unknown = []
+    keys = {}
+    # Only worth it for suffixes longer than the k-mers
+    if memo is not None and m >= memo.length and (kmerTable is None or memo.length > kmerTable.k):
+        column = m - memo.length
+        for i in np.nonzero(lengths >= memo.length)[0].tolist():
+            key = codes[i, column:].tobytes()
+            interval = memo.get(key)
+            if interval is None:
+                unknown.append(i)
+                keys[i] = key
+            else:
+                left[i], right[i] = interval
+                start[i] = column
+
+    for j in range(m - 1, -1, -1):
+        if j == column - 1:
+            _remember(memo, unknown, keys, left, right)
+            unknown = []
+        active = np.nonzero((j >= m - lengths) & (j < start) & (left < right))[0]
+        if len(active) == 0:
+            if j < start.min():
+                break
+            continue
+        c = codes[active, j]
+        invalid = c == INVALID
+        if invalid.any():
+            right[active[invalid]] = 0
+            active = active[~invalid]
+            c = c[~invalid]
+        stats.current.count("rank_lookups", 2 * len(active))
+        if toehold is not None:
+            _follow_toeholds(rank_table, samples, toehold, active, c, right)
+        ranks = rank_table.rank_many(np.concatenate((c, c)), np.concatenate((left[active], right[active])))
+        left[active] = C[c] + ranks[:len(active)]
+        right[active] = C[c] + ranks[len(active):]
+    if unknown:
+        # The loop ended before the column: those reads are done or have no hits
+        _remember(memo, unknown, keys, left, right)
+    return left, right, toehold
+
+def _follow_toeholds(runs, samples, toehold, active, c, right):
+    # The last row of the interval has the letter, or else the last one is at the end of a run
+    k = runs.run_of_many(right[active] - 1)
+    previous = runs.last_run_many(c.astype(np.int64), k)
+    same = np.asarray(runs.run_symbols_array())[k] == c
+    toehold[active] = np.where(same, toehold[active], samples[np.maximum(previous, 0)]) - 1
+
+def _remember(memo, rows, keys, left, right):
+    for i in rows:
+        memo.put(keys[i], (int(left[i]), int(right[i])))
+
+def search_intervals(sequences, bwtMatcher, memo=None):
+    """
+    Yields (read index, (left, right)) for every read of the block with
+    hits, or (read index, (left, right, toehold)) in a run-length index
+    """
+    codes, lengths = encode_reads(sequences, bwtMatcher.alphadic)
+    left, right, toehold = batch_search(codes, lengths, bwtMatcher, memo)
+    for i in np.nonzero(left < right)[0].tolist():
+        if toehold is None:
+            yield i, (int(left[i]), int(right[i]))
+        else:
+            yield i, (int(left[i]), int(right[i]), int(toehold[i]))
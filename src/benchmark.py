@@ -0,0 +1,216 @@
+"""
+Headless benchmarks of fm on the string families of generators.py.
+
+Every (family, size) case runs in a fresh process, which builds the suffix
+array, builds, writes and loads the index and maps a set of reads taken
+from the genome. The time and throughput of every phase, the peak RSS of
+the process and the size of the index file are written as JSON, and
+compared with a baseline file if one is given:
+
+    python3 src/benchmark.py --output results.json
+    python3 src/benchmark.py --baseline results.json
+
+The run fails (exit status 1) if any measure of a case is more than the
+tolerance worse than in the baseline.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import fm
+import generators
+import index
+
+FAMILIES = {
+    "random": generators.generate_random_sequence,
+    "repeats": generators.generate_same_before,
+    "streaky": generators.generate_multiple,
+    "different": generators.generate_different,
+    "fibonacci": generators.generate_fibonacci,
+}
+DEFAULT_SIZES = [10000, 100000]
+DEFAULT_READS = 2000
+DEFAULT_READ_LENGTH = 50
+DEFAULT_TOLERANCE = 0.25
+# Phases that got slower by less than this are within timer noise, whatever the ratio
+MIN_SLOWDOWN = 0.005
+# Measures of a whole case where a larger value is a regression, besides the time of every phase
+MEASURES = ["peak_rss_kb", "index_bytes"]
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmarks of fm preprocessing and search")
+    argparser.add_argument(
+        "--families", nargs="+", choices=sorted(FAMILIES), default=sorted(FAMILIES),
+        help="string families to benchmark (default: all)."
+    )
+    argparser.add_argument(
+        "--sizes", nargs="+", type=int, default=DEFAULT_SIZES,
+        help=f"genome lengths to benchmark (default: {' '.join(map(str, DEFAULT_SIZES))})."
+    )
+    argparser.add_argument(
+        "--alphabet", default="acgt",
+        help="letters of the genomes (default: acgt)."
+    )
+    argparser.add_argument(
+        "--reads", type=int, default=DEFAULT_READS,
+        help=f"number of reads mapped in the search phase (default: {DEFAULT_READS})."
+    )
+    argparser.add_argument(
+        "--read-length", type=int, default=DEFAULT_READ_LENGTH,
+        help=f"length of the reads (default: {DEFAULT_READ_LENGTH})."
+    )
+    argparser.add_argument(
+        "--repeat", type=int, default=3,
+        help="times every phase is run; the fastest run is reported (default: 3)."
+    )
+    argparser.add_argument(
+        "--seed", type=int, default=0,
+        help="seed of the generated genomes and reads (default: 0)."
+    )
+    argparser.add_argument(
+        "--output",
+        help="write the results as JSON to this file."
+    )
+    argparser.add_argument(
+        "--baseline",
+        help="JSON results of an earlier run to compare with."
+    )
+    argparser.add_argument(
+        "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+        help=f"fraction by which a measure may be worse than the baseline (default: {DEFAULT_TOLERANCE})."
+    )
+    args = argparser.parse_args()
+
+    cases = [{"family": family, "size": size, "alphabet": args.alphabet, "reads": args.reads,
+              "readLength": args.read_length, "repeat": args.repeat, "seed": args.seed}
+             for family in args.families for size in args.sizes]
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cases": [run_case(case) for case in cases],
+    }
+    for case in results["cases"]:
+        print(format_case(case), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=1)
+            out.write("\n")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+def run_case(case):
+    """
+    Runs one case in a new process, so its peak RSS is its own
+    """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(measure_case, (case,))
+
+def measure_case(case):
+    """
+    Times every phase of one case and returns its results
+    """
+    random.seed(case["seed"])
+    genome = FAMILIES[case["family"]](case["size"], list(case["alphabet"]))
+    reads = sample_reads(genome, case["reads"], case["readLength"])
+    x = memoryview((genome + "$").encode())
+    records = [["chr1", genome]]
+
+    phases = {}
+    phases["sa_build"] = best_time(lambda: fm.sais_suffix_array(x), case["repeat"]), case["size"], "bases"
+    phases["index_build"] = best_time(lambda: fm.preprocess_genomes(records), case["repeat"]), case["size"], "bases"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        genomeFile = os.path.join(tmpdir, "genome.fa")
+        bwtList = fm.preprocess_genomes(records)
+        phases["index_write"] = (best_time(lambda: index.write_index(fm.index_filename(genomeFile), bwtList), case["repeat"]),
+                                 case["size"], "bases")
+        indexFile = fm.index_filename(genomeFile)
+        indexBytes = os.path.getsize(indexFile)
+        phases["index_load"] = best_time(lambda: fm.load_index(indexFile), case["repeat"]), case["size"], "bases"
+        loaded = fm.load_index(indexFile)
+        hits = []
+        phases["search"] = (best_time(lambda: hits.append(sum(1 for _ in fm.map_reads(reads, loaded))), case["repeat"]),
+                            len(reads), "reads")
+
+    return {
+        "family": case["family"],
+        "size": case["size"],
+        "reads": len(reads),
+        "hits": hits[-1],
+        "index_bytes": indexBytes,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "phases": {name: {"seconds": seconds, "throughput": count / seconds if seconds > 0 else None, "unit": f"{unit}/s"}
+                   for name, (seconds, count, unit) in phases.items()},
+    }
+
+def sample_reads(genome, count, length):
+    """
+    Reads copied from random positions of the genome, every fourth one with
+    a substitution so not all of them have hits
+    """
+    reads = []
+    for i in range(count):
+        start = random.randrange(max(len(genome) - length, 0) + 1)
+        read = list(genome[start:start + length])
+        if i % 4 == 3 and read:
+            read[random.randrange(len(read))] = "x"
+        reads.append([f"read{i}", "".join(read)])
+    return reads
+
+def best_time(run, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Descriptions of the measures that are more than tolerance worse than in
+    the baseline, for the cases and phases that are in both
+
+    >>> old = {"cases": [{"family": "random", "size": 10, "index_bytes": 100, "peak_rss_kb": 10,
+    ...                   "phases": {"search": {"seconds": 1.0}}}]}
+    >>> new = {"cases": [{"family": "random", "size": 10, "index_bytes": 100, "peak_rss_kb": 20,
+    ...                   "phases": {"search": {"seconds": 1.5}}}]}
+    >>> compare(new, old)
+    ['random/10 search seconds: 1.5 vs 1 (+50%)', 'random/10 peak_rss_kb: 20 vs 10 (+100%)']
+    """
+    old = {(case["family"], case["size"]): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        before = old.get((case["family"], case["size"]))
+        if before is None:
+            continue
+        name = f"{case['family']}/{case['size']}"
+        measures = [(f"{phase} seconds", timing["seconds"], before["phases"][phase]["seconds"], MIN_SLOWDOWN)
+                    for phase, timing in case["phases"].items() if phase in before["phases"]]
+        measures += [(measure, case[measure], before[measure], 0) for measure in MEASURES]
+        for label, value, reference, noise in measures:
+            if reference and value > reference * (1 + tolerance) and value - reference > noise:
+                regressions.append(f"{name} {label}: {value:.4g} vs {reference:.4g} ({value / reference - 1:+.0%})")
+    return regressions
+
+def format_case(case):
+    timings = "  ".join(f"{phase} {timing['seconds'] * 1000:.1f}ms" for phase, timing in case["phases"].items())
+    return (f"{case['family']:>10} {case['size']:>8}  {timings}  "
+            f"index {case['index_bytes']} B  peak RSS {case['peak_rss_kb']} kB")
+
+if __name__ == "__main__":
+    main()
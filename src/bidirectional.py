@@ -0,0 +1,71 @@
+"""
+Bidirectional search over a BWTMatcher built with a reverse index.
+
+A pattern P is represented by the interval (forward, reverse, size): the
+rows [forward, forward + size) of the suffixes of the text starting with P,
+and the rows [reverse, reverse + size) of the suffixes of the reversed text
+starting with P reversed. Both are kept in sync, so P can be extended by
+one letter on either side, which is what seed-and-extend needs.
+"""
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+def reverse_complement(sequence):
+    """
+    >>> reverse_complement("aacgN")
+    'Ncgtt'
+    """
+    return sequence.translate(COMPLEMENT)[::-1]
+
+def full_interval(bwtMatcher):
+    """
+    The interval of the empty pattern
+    """
+    return 0, 0, len(bwtMatcher.f)
+
+def extend_left(bwtMatcher, interval, c):
+    """
+    The interval of cP given the interval of P, for the symbol code c.
+    The reverse interval moves past the rows of P reversed followed by a
+    symbol smaller than c, which are the rows of P preceded by one.
+    """
+    return _extend(bwtMatcher.rank_table, bwtMatcher.C, interval, c)
+
+def extend_right(bwtMatcher, interval, c):
+    """
+    The interval of Pc given the interval of P, for the symbol code c
+    """
+    reverse_rank_table = require_reverse_index(bwtMatcher)
+    reverse, forward, size = _extend(reverse_rank_table, bwtMatcher.C, (interval[1], interval[0], interval[2]), c)
+    return forward, reverse, size
+
+def _extend(rank_table, C, interval, c):
+    start, other, size = interval
+    end = start + size
+    occ = rank_table.rank
+    before = occ(c, start)
+    smaller = sum(occ(b, end) - occ(b, start) for b in range(c))
+    return C[c] + before, other + smaller, occ(c, end) - before
+
+def require_reverse_index(bwtMatcher):
+    """
+    The rank table of the reversed text, which extending to the right needs
+    """
+    if bwtMatcher.reverse_rank_table is None:
+        raise ValueError("bidirectional search needs an index preprocessed with --reverse-index")
+    return bwtMatcher.reverse_rank_table
+
+def search(bwtMatcher, p):
+    """
+    The interval of p, or None if p does not occur (or has letters that are
+    not in the genome)
+    """
+    require_reverse_index(bwtMatcher)
+    interval = full_interval(bwtMatcher)
+    for a in reversed(p):
+        c = bwtMatcher.alphadic.get(a)
+        if c is None:
+            return None
+        interval = extend_left(bwtMatcher, interval, c)
+        if interval[2] == 0:
+            return None
+    return interval
@@ -0,0 +1,61 @@
+import heapq
+import pickle
+import tempfile
+
+DEFAULT_BUFFER_SIZE = 1_000_000
+
+class ExternalSorter:
+    """
+    Sorts a stream of items with bounded memory. Items are kept in memory
+    until bufferSize of them have been added; the buffer is then sorted and
+    spilled to a temporary file as a run, and iterating merges all the runs.
+    """
+    def __init__(self, key=None, bufferSize=DEFAULT_BUFFER_SIZE, tmpdir=None):
+        self.key = key
+        self.bufferSize = bufferSize
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.runs = []
+
+    def add(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.bufferSize:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort(key=self.key)
+        run = tempfile.TemporaryFile(dir=self.tmpdir)
+        pickler = pickle.Pickler(run, protocol=pickle.HIGHEST_PROTOCOL)
+        for item in self.buffer:
+            pickler.dump(item)
+            # The memo would otherwise keep every item of the run alive
+            pickler.clear_memo()
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+
+    def __iter__(self):
+        """
+        Yields every added item in sorted order
+
+        >>> sorter = ExternalSorter(bufferSize=2)
+        >>> for x in [5, 3, 4, 1, 2]: sorter.add(x)
+        >>> list(sorter)
+        [1, 2, 3, 4, 5]
+        """
+        self.buffer.sort(key=self.key)
+        if not self.runs:
+            yield from self.buffer
+            return
+        runs = [_read_run(run) for run in self.runs]
+        yield from heapq.merge(*runs, self.buffer, key=self.key)
+        for run in self.runs:
+            run.close()
+
+def _read_run(run):
+    unpickler = pickle.Unpickler(run)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
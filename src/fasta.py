@@ -1,9 +1,18 @@
 def fasta_parse(file):
-    out = []
+    """
+    Yields [name, sequence] for every record in file, as soon as it is read.
+    The lines of a sequence are collected and joined once at the end of the
+    record instead of being concatenated one by one.
+    """
+    name = None
+    chunks = []
     for l in file:
         if l.startswith(">"):
-            trimmed = l[1:].strip()
-            out.append([trimmed, ""])
+            if name is not None:
+                yield [name, "".join(chunks)]
+            name = l[1:].strip()
+            chunks = []
         else:
-            out[-1][1] += l.strip()
-    return out
\ No newline at end of file
+            chunks.append(l.strip())
+    if name is not None:
+        yield [name, "".join(chunks)]
@@ -1,8 +1,13 @@
 def fastq_parser(file):
-    out = []
-    for l in (l for l in file):
+    """
+    Yields [name, sequence] for every read in file, as soon as it is read.
+    Quality lines ('+' separator and the line after it) are skipped.
+    """
+    lines = iter(file)
+    for l in lines:
         if l.startswith('@'):
-            out.append([l[1:].strip()])
-        else:
-            out[-1].append(l.strip())
-    return out
\ No newline at end of file
+            name = l[1:].strip()
+            sequence = next(lines, "").strip()
+            yield [name, sequence]
+        elif l.startswith('+'):
+            next(lines, None)
@@ -1,104 +1,1149 @@
 import argparse
 import sys
 import fasta, fastq
-import pickle
+import sais
+import rank
+import sampling
+import index
+import extsort
+import batch
+import kmers
+import approx
+import bidirectional
+import seeds
+import readers
+import server
+import stats
+import cProfile
+import multiprocessing
+from itertools import islice
 import os
 import re
-from collections import defaultdict
+import tempfile
+import hashlib
+import inspect
+import numpy as np
+from collections import defaultdict, deque
+from bisect import bisect_right
+
+DEFAULT_BATCH_SIZE = 10000
+# Options of map_reads and their defaults. The command line gives all of them (mapping_options),
+# and the same dict is sent as a --connect job and to the processes of -j.
+MAPPING_OPTIONS = {
+    "batchSize": DEFAULT_BATCH_SIZE,
+    "edits": 0,
+    "memoSize": 0,
+    "memoLength": batch.DEFAULT_MEMO_LENGTH,
+    "bothStrands": False,
+    "seeds": None,
+    "report": "hits",
+    "maxHits": None,
+    "unsorted": False,
+    "sortBuffer": extsort.DEFAULT_BUFFER_SIZE,
+    "ioThreads": readers.DEFAULT_THREADS,
+}
+# Joins the records of a genome into one text. Sequence lines are stripped,
+# so it can never be part of a read and no hit can span two records.
+SEPARATOR = "\n"
+# Peak memory of building the index of one base, to split the genome in segments with --max-memory
+BUILD_BYTES_PER_BASE = 180
+# Memory in use before building anything (the interpreter, numpy and fm itself, measured at 33 MB),
+# taken out of --max-memory before it is split among the bases
+BUILD_BASELINE_BYTES = 40 << 20
+# Suffix array values handled at a time when it is spilled to disk
+SPILL_BLOCK = 1 << 20
+# Options of build_matcher that change the index (saBuilder and spill only change how it is built)
+BUILD_PARAMETERS = ["rankSample", "saSample", "saSampleMode", "kmerLength", "reverseIndex", "rankBackend", "isaSample"]
 
 class BWTMatcher:
-    def __init__(self, f, rank_table, firstIndexList, alphadic):
+    def __init__(self, f: sampling.SampledSuffixArray, rank_table: rank.RankTable, firstIndexList, alphadic,
+                 names, starts, kmerTable: kmers.KmerTable = None, reverse_rank_table: rank.RankTable = None,
+                 hashes=None, isa: sampling.SampledInverseSuffixArray = None, build=None):
         self.rank_table = rank_table
         self.f = f
         self.firstIndexList = firstIndexList
         self.alphadic = alphadic
+        # firstIndexList indexed by symbol code instead of by letter, for LF-mapping
+        self.C = [firstIndexList[a] for a in alphadic]
+        # Names of the records joined in the text and where each of them starts
+        self.names = names
+        self.starts = starts
+        # Content hash of every record, to find the ones that changed when updating the index
+        self.hashes = hashes
+        # Optional SA intervals of every k-mer, to skip the first k steps of a search
+        self.kmers = kmerTable
+        # Optional rank structure over the BWT of the reversed text (same alphabet and C)
+        self.reverse_rank_table = reverse_rank_table
+        # Sampled inverse suffix array, to extract text from the BWT
+        self.isa = isa
+        # build_parameters it was built with, to only reuse it for an index built the same way
+        self.build = build
+        self.letters = list(alphadic)
+
+    def chromosome(self, position):
+        """
+        Maps a position in the joined text to (record index, offset in the record)
+        """
+        i = bisect_right(self.starts, position) - 1
+        return i, position - self.starts[i]
+
+    def chromosome_length(self, i):
+        if i + 1 < len(self.starts):
+            return self.starts[i+1] - self.starts[i] - len(SEPARATOR)
+        return len(self.f) - 1 - self.starts[i]
 
 def main():
     argparser = argparse.ArgumentParser(
         description="FM-index exact pattern matching",
-        usage="\n\tfm -p genome\n\tfm genome reads"
+        usage="\n\tfm -p genome\n\tfm genome reads\n\tfm --serve socket\n\tfm --connect socket genome reads"
     )
     argparser.add_argument(
         "-p", action="store_true",
         help="preprocess the genome."
     )
     argparser.add_argument(
-        "genome",
-        help="Simple-FASTA file containing the genome.",
-        type=argparse.FileType('r')
+        "--sa", choices=sorted(SA_BUILDERS), default="sais",
+        help="suffix array construction algorithm used when preprocessing (default: sais)."
+    )
+    argparser.add_argument(
+        "-k", "--rank-sample", type=positive_int, default=rank.DEFAULT_SAMPLE_RATE,
+        help=f"store rank checkpoints every k BWT positions when preprocessing; "
+             f"smaller k uses more memory but searches faster (default: {rank.DEFAULT_SAMPLE_RATE})."
+    )
+    argparser.add_argument(
+        "--rank-backend", choices=["auto"] + sorted(rank.RANK_TABLES), default="auto",
+        help="representation of the BWT when preprocessing: one byte per symbol (plain), two bits "
+             "per symbol for the four most common ones plus a list of the others (packed), a wavelet "
+             "matrix (wavelet), or the runs of the BWT with suffix array samples only at run boundaries "
+             "(runs, an r-index for collections of near-identical genomes, which ignores -s); auto packs DNA, uses a wavelet matrix for alphabets of more than "
+             f"{rank.WAVELET_MIN_SIGMA} symbols such as protein, and plain otherwise (default: auto)."
+    )
+    argparser.add_argument(
+        "-s", "--sa-sample", type=positive_int, default=1,
+        help="only store one in every s suffix array values when preprocessing; "
+             "the others are recovered by LF-mapping when reporting hits (default: 1)."
+    )
+    argparser.add_argument(
+        "--isa-sample", type=positive_int, metavar="T",
+        help="store the row of one in every T text positions when preprocessing, so any part of the "
+             f"genome can be rebuilt from the index with --extract (default: {sampling.DEFAULT_ISA_SAMPLE}, "
+             "or none with --rank-backend runs, which then needs this option for --extract)."
+    )
+    argparser.add_argument(
+        "--sa-sample-mode", choices=["text", "row"], default="text",
+        help="sample the suffix array values that are multiples of s (text), "
+             "or every s-th row of the suffix array (row) (default: text)."
+    )
+    argparser.add_argument(
+        "--kmer-length", type=int, default=0,
+        help="store the suffix array interval of every k-mer when preprocessing, so searches "
+             "start from the interval of the last k letters of the read; 10-12 suits DNA (default: 0, off)."
+    )
+    argparser.add_argument(
+        "--reverse-index", action="store_true",
+        help="also store the BWT of the reversed genome when preprocessing, making the index bidirectional; "
+             "approximate searches use it to prune hopeless branches and seeding to extend matches to the right."
+    )
+    argparser.add_argument(
+        "--max-memory", type=parse_size, metavar="BYTES",
+        help="when preprocessing, split the genome in segments (of whole records) that can be built in "
+             "about this much memory, e.g. 512M or 4G, build them one after the other (or j at a time, "
+             "sharing the memory) with the suffix arrays spilled to temporary files, and write every "
+             "segment to the index as soon as it is built. A single record is never split, so one that "
+             "is too large on its own is built anyway, with a warning (default: no limit)."
+    )
+    argparser.add_argument(
+        "--incremental", action="store_true",
+        help="when preprocessing, keep the parts of the existing index whose records did not "
+             "change and only build the new or changed records."
+    )
+    argparser.add_argument(
+        "--extract", type=parse_region, action="append", metavar="REGION",
+        help="write the letters of REGION (chrom, chrom:start or chrom:start-end, 1-based and inclusive) "
+             "as FASTA, rebuilt from the index of the genome alone; may be given several times."
+    )
+    argparser.add_argument(
+        "--serve", metavar="SOCKET",
+        help="keep running and map the jobs sent to the Unix socket SOCKET with --connect, "
+             "keeping the loaded indexes in memory."
+    )
+    argparser.add_argument(
+        "--cache-size", type=int, default=server.DEFAULT_CACHE_SIZE,
+        help=f"bytes of indexes kept loaded by --serve (default: {server.DEFAULT_CACHE_SIZE})."
+    )
+    argparser.add_argument(
+        "--connect", metavar="SOCKET",
+        help="send the search to the fm --serve process listening on SOCKET."
+    )
+    argparser.add_argument(
+        "--stats", metavar="FILE",
+        help="write the time spent in every phase and counters of the work done as JSON "
+             "to FILE, or to standard error if FILE is -."
+    )
+    argparser.add_argument(
+        "--profile", metavar="FILE",
+        help="run under cProfile and write the profile to FILE, for pstats or snakeviz."
+    )
+    argparser.add_argument(
+        "genome", nargs="?",
+        help="Simple-FASTA file containing the genome, which may be compressed with gzip, bgzip or bzip2.",
+        type=input_file
     )
     argparser.add_argument(
         "reads", nargs="?",
-        help="Simple-FASTQ file containing the reads.",
-        type=argparse.FileType('r')
+        help="Simple-FASTQ file containing the reads, which may be compressed with gzip, bgzip or bzip2.",
+        type=input_file
+    )
+    argparser.add_argument(
+        "-d", "--edits", type=int, default=0,
+        help="report hits with up to d substitutions, insertions or deletions (default: 0)."
+    )
+    argparser.add_argument(
+        "-j", "--jobs", type=positive_int, default=1,
+        help="number of processes mapping reads, which share the memory-mapped index, or building "
+             "the index with -p, which is then split in up to j parts searched one after the other (default: 1)."
+    )
+    argparser.add_argument(
+        "--io-threads", type=int, default=readers.DEFAULT_THREADS, metavar="N",
+        help="number of threads decompressing the blocks of bgzip (BGZF) input files, "
+             f"which other gzip files can not be (default: {readers.DEFAULT_THREADS})."
+    )
+    argparser.add_argument(
+        "--batch-size", type=positive_int, default=DEFAULT_BATCH_SIZE,
+        help=f"number of reads sent to a process at a time with -j (default: {DEFAULT_BATCH_SIZE})."
+    )
+    argparser.add_argument(
+        "--both-strands", action="store_true",
+        help="also map the reverse complement of every read, and add a last column with the strand "
+             "of every hit (+ or -); reverse strand hits show the reverse complemented read."
+    )
+    argparser.add_argument(
+        "--seeds", choices=seeds.Seeding.MODES,
+        help="report the seeds of every read instead of whole read hits: its super-maximal exact matches "
+             "(smem, which needs an index preprocessed with --reverse-index) or its non-overlapping pieces "
+             "of --seed-length letters (fixed). Every occurrence of a seed is a line whose CIGAR soft clips "
+             "the rest of the read."
+    )
+    argparser.add_argument(
+        "--seed-length", type=positive_int, default=seeds.DEFAULT_SEED_LENGTH,
+        help=f"minimum length of the super-maximal exact matches, or length of the fixed seeds "
+             f"(default: {seeds.DEFAULT_SEED_LENGTH})."
+    )
+    argparser.add_argument(
+        "--max-occ", type=non_negative_int, default=seeds.DEFAULT_MAX_OCCURRENCES,
+        help=f"skip the seeds with more occurrences than this (default: {seeds.DEFAULT_MAX_OCCURRENCES})."
+    )
+    argparser.add_argument(
+        "--report", choices=["hits", "count", "interval"], default="hits",
+        help="what is written for every read: its hits (hits), only its number of exact hits, without "
+             "locating them (count), or the suffix array interval of its exact hits in every segment of "
+             "the index, as segment, left and right (interval) (default: hits)."
+    )
+    argparser.add_argument(
+        "--max-hits", type=non_negative_int, metavar="K",
+        help="only locate and report up to K hits of every read (and strand) (default: all)."
+    )
+    argparser.add_argument(
+        "--memo-size", type=non_negative_int, default=0,
+        help="remember the suffix array intervals of the last --memo-length letters of up to this many "
+             "recently searched reads, so reads ending the same way skip that part of the search (default: 0, off)."
+    )
+    argparser.add_argument(
+        "--memo-length", type=positive_int, default=batch.DEFAULT_MEMO_LENGTH,
+        help=f"length of the read suffixes remembered with --memo-size (default: {batch.DEFAULT_MEMO_LENGTH})."
+    )
+    argparser.add_argument(
+        "--unsorted", action="store_true",
+        help="write hits as soon as they are found, in the order of the reads, "
+             "instead of sorted by read, chromosome and position."
+    )
+    argparser.add_argument(
+        "--sort-buffer", type=int, default=extsort.DEFAULT_BUFFER_SIZE,
+        help=f"number of hits kept in memory while sorting before spilling them "
+             f"to a temporary file (default: {extsort.DEFAULT_BUFFER_SIZE})."
     )
     args = argparser.parse_args()
 
-    if args.genome is None:
+    if args.rank_backend == "packed" and args.rank_sample % rank.PACKED_SYMBOLS:
+        argparser.error(f"-k must be a multiple of {rank.PACKED_SYMBOLS} with --rank-backend packed")
+    if args.max_memory is not None and args.max_memory <= BUILD_BASELINE_BYTES:
+        argparser.error(f"--max-memory must be more than {BUILD_BASELINE_BYTES >> 20}M, "
+                        "which is in use before building anything")
+    try:
+        with_defaults(mapping_options(args))
+    except ValueError as e:
+        argparser.error(str(e))
+    # Searching needs the optional argument reads, and everything but --serve a genome
+    if args.serve is None and (args.genome is None or (args.reads is None and not args.p and not args.extract)):
         argparser.print_help()
         sys.exit(1)
 
-    if args.p:
-        genomes = fasta.fasta_parse(args.genome)
-        genomes_to_file(args.genome.name, genomes)
+    if args.stats is not None:
+        stats.enable()
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats == "-":
+            stats.current.write(sys.stderr)
+        elif args.stats is not None:
+            with open(args.stats, "w") as out:
+                stats.current.write(out)
+
+def run(args):
+    if args.serve is not None:
+        cache = server.IndexCache(load_index, args.cache_size)
+        try:
+            server.serve(args.serve, lambda job, out, start: run_job(cache, job, out, start))
+        except OSError as e:
+            sys.exit(f"fm: {e}")
+        return
+
+    if args.extract:
+        try:
+            bwtList = load_index(ensure_index(args.genome, **preprocess_options(args)))
+            for chrom, start, end in args.extract:
+                sequence = extract(bwtList, chrom, start, end)
+                sys.stdout.write(f">{chrom}:{start + 1}-{start + len(sequence)}\n{sequence}\n")
+        except ValueError as e:
+            sys.exit(f"fm: {e}")
+    elif args.p:
+        with readers.open_text(args.genome, args.io_threads) as genomeFile:
+            genomes = stats.current.timed(fasta.fasta_parse(genomeFile), "parse_genome")
+            try:
+                if args.incremental:
+                    update_genomes_file(args.genome, genomes, args.jobs, **preprocess_options(args))
+                else:
+                    genomes_to_file(args.genome, genomes, args.jobs, **preprocess_options(args))
+            except ValueError as e:
+                sys.exit(f"fm: {e}")
     else:
-        # here we need the optional argument reads
-        if args.reads is None:
-            argparser.print_help()
-            sys.exit(1)
-        
-        genomes = fasta.fasta_parse(args.genome)
-        bwtList = None
-        # Check if we have a .dat file
-        datFile = args.genome.name+".dat"
-        if os.path.isfile(datFile):
-            datFileStream = open(datFile, "rb")
-            bwtList = pickle.load(datFileStream)
-        else:
-            bwtList = genomes_to_file(args.genome, genomes)
+        options = mapping_options(args)
+        if args.connect is not None:
+            job = {
+                "genome": os.path.abspath(args.genome),
+                "reads": os.path.abspath(args.reads),
+                "options": options,
+            }
+            try:
+                server.submit(args.connect, job, sys.stdout)
+            except (OSError, RuntimeError) as e:
+                sys.exit(f"fm: {e}")
+            return
         
-        reads = fastq.fastq_parser(args.reads)
+        try:
+            indexFile = ensure_index(args.genome, **preprocess_options(args))
+            with stats.current.phase("index_load"):
+                bwtList = load_index(indexFile)
+            # map_reads does this too, but only once the first reads are read
+            seeds_for(options["seeds"], bwtList)
+        except ValueError as e:
+            sys.exit(f"fm: {e}")
+        stats.current.count("index_bytes", os.path.getsize(indexFile))
+
+        with readers.open_text(args.reads, options["ioThreads"]) as readsFile:
+            reads = stats.current.timed(fastq.fastq_parser(readsFile), "parse_reads")
+            if args.jobs > 1:
+                hits = map_reads_parallel(reads, indexFile, args.jobs, options)
+            else:
+                hits = map_reads(reads, bwtList, options)
+            hits = stats.current.timed(hits, "map")
+            write_results(hits, sys.stdout, options)
+        stats.current.count("reads_bytes", os.path.getsize(args.reads))
+
+def run_job(cache, job, out, start):
+    """
+    Maps a job received by fm --serve, with the indexes taken from cache
+    """
+    bwtList = cache.get(ensure_index(job["genome"]))
+    options = with_defaults(job.get("options"))
+    seeds_for(options["seeds"], bwtList)
+    with readers.open_text(job["reads"], options["ioThreads"]) as readsFile:
+        start()
+        hits = map_reads(fastq.fastq_parser(readsFile), bwtList, options)
+        write_results(hits, out, options)
+
+def map_reads(reads, bwtList, options=None, memos=None):
+    """
+    Yields (read, chromosome, position, cigar, sequence, strand) for every hit,
+    read by read, with the names split by getTrailingNumber. options holds
+    any of MAPPING_OPTIONS, the others take their default. Exact backward
+    searches are done batchSize reads at a time with batch.search_intervals;
+    with edits > 0 every read goes through approx.approximate_search instead.
+    Identical reads of a batch are only searched and located once. memos
+    holds a batch.SuffixMemo for every BWTMatcher, kept across calls, or else
+    they are made from memoSize and memoLength. With bothStrands the reverse
+    complement of every read is searched in the same batch, and its hits
+    have strand "-" and the reverse complemented sequence. With seeds (the
+    keyword arguments of a seeds.Seeding) the hits are the occurrences of
+    the seeds of every read instead, with the read outside the seed soft
+    clipped. With maxHits only that many hits of every read and strand are
+    located and reported.
+
+    With report "count" or "interval" nothing is located: it yields
+    (read, strand, count, intervals) for every read and strand instead,
+    where intervals are the (index of the BWTMatcher, left, right) of the
+    suffix array intervals of the exact hits, which count in total.
+    """
+    options = with_defaults(options)
+    batchSize, edits, bothStrands, report, maxHits = (options[name] for name in
+                                                      ("batchSize", "edits", "bothStrands", "report", "maxHits"))
+    seeding = seeds_for(options["seeds"], bwtList)
+    matchers = [(bwtMatcher, [getTrailingNumber(name) for name in bwtMatcher.names]) for bwtMatcher in bwtList]
+    if memos is None:
+        memos = suffix_memos(bwtList, options["memoSize"], options["memoLength"]) or [None] * len(bwtList)
+    for block in batched(reads, batchSize):
+        block = [r for r in block if len(r[1]) > 0]
+        # Every distinct sequence of the block and the index of its first read
+        distinct = {}
+        for r in block:
+            distinct.setdefault(r[1], len(distinct))
+        stats.current.count("reads", len(block))
+        stats.current.count("distinct_reads", len(distinct))
+        sequences = list(distinct)
+        # Strand of every searched sequence: the distinct reads, then their reverse complements
+        strands = [("+", 0)]
+        if bothStrands:
+            sequences += [bidirectional.reverse_complement(sequence) for sequence in distinct]
+            strands.append(("-", len(distinct)))
+        with stats.current.phase("search"):
+            if seeding is not None:
+                seedLists = [seeding.search(bwtMatcher, sequences) for bwtMatcher, _ in matchers]
+                found = [None] * len(sequences)
+            elif edits > 0:
+                found = [list(islice(approximate_hits(sequence, matchers, edits), maxHits)) for sequence in sequences]
+            else:
+                intervals = [dict(batch.search_intervals(sequences, bwtMatcher, memo))
+                             for (bwtMatcher, _), memo in zip(matchers, memos)]
+                found = [None] * len(sequences)
+        if report != "hits":
+            yield from report_intervals(block, distinct, strands, intervals)
+            continue
+        for r in block:
+            readName = None
+            for strand, offset in strands:
+                j = distinct[r[1]] + offset
+                if found[j] is None:
+                    with stats.current.phase("locate"):
+                        if seeding is None:
+                            found[j] = list(exact_hits(j, sequences[j], matchers, intervals, maxHits))
+                        else:
+                            found[j] = list(islice(seed_hits(j, sequences[j], matchers, seedLists, seeding.maxOccurrences),
+                                                   maxHits))
+                    stats.current.count("hits_located", len(found[j]))
+                if not found[j]:
+                    continue
+                stats.current.count("hits", len(found[j]))
+                if readName is None:
+                    readName = getTrailingNumber(r[0])
+                for chromosome, position, cigar in found[j]:
+                    yield (readName, chromosome, position, cigar, sequences[j], strand)
+
+def report_intervals(block, distinct, strands, intervals):
+    """
+    (read, strand, count, intervals) of every read of a block and strand,
+    given the intervals found for the block in every BWTMatcher
+    """
+    for r in block:
+        readName = getTrailingNumber(r[0])
+        for strand, offset in strands:
+            j = distinct[r[1]] + offset
+            spans = [(s, found[j][0], found[j][1]) for s, found in enumerate(intervals) if j in found]
+            count = sum(right - left for _, left, right in spans)
+            stats.current.count("hits", count)
+            yield (readName, strand, count, spans)
 
-        out = []
+def exact_hits(j, sequence, matchers, intervals, maxHits=None):
+    """
+    (chromosome, position, cigar) of every hit of the j-th sequence of a block,
+    given the intervals found for the block in every BWTMatcher, or of the
+    first maxHits of them
+    """
+    for (bwtMatcher, chromosomes), found in zip(matchers, intervals):
+        if j not in found:
+            continue
+        if maxHits is not None and maxHits <= 0:
+            return
+        positions = locate_interval(bwtMatcher, *found[j], p=sequence, limit=maxHits)
+        if maxHits is not None:
+            maxHits -= len(positions)
+        for position in positions:
+            i, offset = bwtMatcher.chromosome(position)
+            yield (chromosomes[i], offset+1, f"{len(sequence)}M")
 
-        for i, g in enumerate(genomes):
-            if len(g[1]) == 0:
+def seed_hits(j, sequence, matchers, seedLists, maxOccurrences):
+    """
+    (chromosome, position, cigar) of every occurrence of the seeds of the
+    j-th sequence of a block, given the seeds found for the block in every
+    BWTMatcher. Seeds with more than maxOccurrences occurrences in a
+    BWTMatcher are skipped.
+    """
+    for (bwtMatcher, chromosomes), seedList in zip(matchers, seedLists):
+        stats.current.count("seeds", len(seedList[j]))
+        for start, end, interval in seedList[j]:
+            if interval[1] - interval[0] > maxOccurrences:
+                stats.current.count("seeds_skipped")
                 continue
-            for r in reads:
-                length = len(r[1])
-                if length == 0:
+            cigar = seeds.seed_cigar(start, end, len(sequence))
+            for position in locate_interval(bwtMatcher, *interval, p=sequence[start:end]):
+                i, offset = bwtMatcher.chromosome(position)
+                yield (chromosomes[i], offset+1, cigar)
+
+def approximate_hits(sequence, matchers, edits):
+    """
+    (chromosome, position, cigar) of every hit of a sequence with up to the
+    given number of edits, each distinct (position, cigar) pair reported once
+    """
+    for bwtMatcher, chromosomes in matchers:
+        letters = list(getLetters(bwtMatcher.alphadic))
+        seen = set()
+        for left, right, cigar in approx.approximate_search(sequence, bwtMatcher, edits, letters):
+            for row in range(left, right):
+                position = locate(bwtMatcher, row)
+                if (position, cigar) in seen:
                     continue
-                matches = searchPattern(r[1], bwtList[i])
-                for m in matches:
-                    out.append((getTrailingNumber(r[0]), getTrailingNumber(g[0]), m+1, length, r[1]))
+                seen.add((position, cigar))
+                i, offset = bwtMatcher.chromosome(position)
+                yield (chromosomes[i], offset+1, cigar)
+
+def suffix_memos(bwtList, memoSize, memoLength=batch.DEFAULT_MEMO_LENGTH):
+    """
+    One batch.SuffixMemo of memoSize entries per BWTMatcher, or None if memoSize is 0
+    """
+    if memoSize <= 0:
+        return None
+    return [batch.SuffixMemo(memoSize, memoLength) for _ in bwtList]
+
+_workerBwtList = None
+_workerMemos = None
+_workerStats = False
+# Options of map_reads
+_workerOptions = {}
+
+def _init_worker(indexFile, options, collectStats):
+    global _workerBwtList, _workerMemos, _workerStats, _workerOptions
+    _workerBwtList = load_index(indexFile)
+    _workerMemos = suffix_memos(_workerBwtList, options["memoSize"], options["memoLength"])
+    _workerStats = collectStats
+    _workerOptions = options
+
+def _map_batch(reads):
+    """
+    The hits of a batch, and the stats of mapping it if they are collected
+    """
+    hits = map_reads(reads, _workerBwtList, dict(_workerOptions, batchSize=len(reads)), _workerMemos)
+    if not _workerStats:
+        return list(hits), None
+    batchStats = stats.enable()
+    hits = list(batchStats.timed(hits, "map"))
+    return hits, batchStats.summary()
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def map_reads_parallel(reads, indexFile, jobs, options=None):
+    """
+    Same as map_reads, but maps batches of reads in a pool of processes that
+    each memory-map indexFile (and keep their own suffix memos). Only 2
+    batches per process are in flight at a time and the results are yielded
+    in the order of the reads. The stats of the workers are added to
+    stats.current, so their phases count the time of every process.
+    """
+    options = with_defaults(options)
+    with multiprocessing.Pool(jobs, _init_worker, (indexFile, options, stats.current.enabled)) as pool:
+        pending = deque()
+        for block in batched(reads, options["batchSize"]):
+            pending.append(pool.apply_async(_map_batch, (block,)))
+            if len(pending) >= 2 * jobs:
+                yield from _collect(pending.popleft())
+        while pending:
+            yield from _collect(pending.popleft())
+
+def _collect(result):
+    hits, summary = result.get()
+    if summary is not None:
+        stats.current.merge(summary)
+    return hits
+
+def write_results(hits, out, options=None):
+    """
+    Writes what map_reads found with the same options, sorted unless unsorted is set
+    """
+    options = with_defaults(options)
+    report, strands, unsorted, bufferSize = (options[name] for name in ("report", "bothStrands", "unsorted", "sortBuffer"))
+    if report == "hits":
+        if not unsorted:
+            hits = sort_hits(hits, bufferSize)
+        write_hits(hits, out, strands)
+    else:
+        if not unsorted:
+            hits = sort_hits(hits, bufferSize, key=lambda x: (x[0], x[1]))
+        write_counts(hits, out, report, strands)
+
+def sort_hits(hits, bufferSize=extsort.DEFAULT_BUFFER_SIZE, key=lambda x: (x[0], x[1], x[2], x[3], x[5])):
+    """
+    Sorts hits by read, chromosome, position, cigar and strand (or by key) with bounded memory
+    """
+    sorter = extsort.ExternalSorter(key=key, bufferSize=bufferSize)
+    with stats.current.phase("sort"):
+        for t in hits:
+            sorter.add(t)
+    return stats.current.timed(sorter, "sort")
+
+def write_hits(hits, out, strands=False):
+    """
+    Writes the hits in the output format, with the strand as an extra last column if strands is set
+    """
+    with stats.current.phase("output"):
+        for t in hits:
+            if strands:
+                out.write(f"{t[0][0]}{t[0][1]}\t{t[1][0]}{t[1][1]}\t{t[2]}\t{t[3]}\t{t[4]}\t{t[5]}\n")
+            else:
+                out.write(f"{t[0][0]}{t[0][1]}\t{t[1][0]}{t[1][1]}\t{t[2]}\t{t[3]}\t{t[4]}\n")
+
+def mapping_options(args):
+    """
+    MAPPING_OPTIONS given on the command line
+    """
+    return {
+        "batchSize": args.batch_size,
+        "edits": args.edits,
+        "memoSize": args.memo_size,
+        "memoLength": args.memo_length,
+        "bothStrands": args.both_strands,
+        "seeds": seeding_options(args),
+        "report": args.report,
+        "maxHits": args.max_hits,
+        "unsorted": args.unsorted,
+        "sortBuffer": args.sort_buffer,
+        "ioThreads": args.io_threads,
+    }
+
+def with_defaults(options):
+    """
+    options completed with the defaults of MAPPING_OPTIONS. Unknown options,
+    or options that can not be used together, raise ValueError.
+
+    >>> with_defaults({"edits": 1})["edits"], with_defaults(None)["report"]
+    (1, 'hits')
+    >>> with_defaults({"edit": 1})
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown mapping options: edit
+    >>> with_defaults({"edits": 1, "report": "count"})
+    Traceback (most recent call last):
+    ...
+    ValueError: --report count only applies to exact hits, not to -d or --seeds
+    >>> with_defaults({"maxHits": 5, "report": "interval"})
+    Traceback (most recent call last):
+    ...
+    ValueError: --max-hits only applies to --report hits, not to --report interval
+    """
+    options = options or {}
+    unknown = set(options) - set(MAPPING_OPTIONS)
+    if unknown:
+        raise ValueError(f"unknown mapping options: {', '.join(sorted(unknown))}")
+    options = dict(MAPPING_OPTIONS, **options)
+    if options["seeds"] is not None and options["edits"] > 0:
+        raise ValueError("--seeds can not be combined with -d")
+    if options["report"] != "hits" and (options["edits"] > 0 or options["seeds"] is not None):
+        raise ValueError(f"--report {options['report']} only applies to exact hits, not to -d or --seeds")
+    if options["maxHits"] is not None:
+        if options["maxHits"] < 0:
+            raise ValueError(f"--max-hits must be at least 0, not {options['maxHits']}")
+        if options["report"] != "hits":
+            raise ValueError(f"--max-hits only applies to --report hits, not to --report {options['report']}")
+    return options
+
+def seeding_options(args):
+    """
+    Keyword arguments of seeds.Seeding given on the command line, or None without --seeds
+    """
+    if args.seeds is None:
+        return None
+    return {"mode": args.seeds, "length": args.seed_length, "maxOccurrences": args.max_occ}
+
+def seeds_for(options, bwtList):
+    """
+    The seeds.Seeding of the options, or None. SMEMs need the reverse index,
+    which is checked before any read is mapped.
+    """
+    if options is None:
+        return None
+    seeding = seeds.Seeding(**options)
+    if seeding.mode == "smem":
+        for bwtMatcher in bwtList:
+            bidirectional.require_reverse_index(bwtMatcher)
+    return seeding
+
+def input_file(filename):
+    """
+    The name of an input file, checked to be readable when parsing the command line
+    """
+    try:
+        with open(filename, "rb"):
+            return filename
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"can't open '{filename}': {e}")
 
-        for t in sorted(out, key=lambda x: (x[0], x[1], x[2])):
-            print(f"{t[0][0]}{t[0][1]}\t{t[1][0]}{t[1][1]}\t{t[2]}\t{t[3]}M\t{t[4]}")
+def positive_int(text):
+    """
+    A whole number of at least 1
+
+    >>> positive_int("64")
+    64
+    >>> positive_int("0")
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: must be a positive integer: '0'
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {text!r}")
+    return value
+
+def non_negative_int(text):
+    """
+    A whole number of at least 0
+
+    >>> non_negative_int("0")
+    0
+    >>> non_negative_int("-1")
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: must be a non-negative integer: '-1'
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must be a non-negative integer: {text!r}")
+    return value
+
+def parse_size(text):
+    """
+    A number of bytes with an optional K, M or G suffix (powers of 1024)
+
+    >>> parse_size("4096"), parse_size("512M"), parse_size("2g")
+    (4096, 536870912, 2147483648)
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    unit = units.get(text[-1:], 1)
+    if text[-1:] in units:
+        text = text[:-1]
+    try:
+        return int(float(text) * unit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
+
+def write_counts(rows, out, report, strands=False):
+    """
+    Writes the (read, strand, count, intervals) of map_reads: the number of
+    hits of every read with report "count", or with report "interval" one
+    line with the index of the BWTMatcher (the segment of the index) and
+    the suffix array interval of every interval with hits. The strand is an
+    extra last column if strands is set.
+
+    >>> import io
+    >>> rows = [(("read", 1), "+", 3, [(0, 5, 7), (1, 2, 3)]), (("read", 2), "+", 0, [])]
+    >>> out = io.StringIO(); write_counts(rows, out, "count"); out.getvalue()
+    'read1\\t3\\nread2\\t0\\n'
+    >>> out = io.StringIO(); write_counts(rows, out, "interval", strands=True); out.getvalue()
+    'read1\\t0\\t5\\t7\\t+\\nread1\\t1\\t2\\t3\\t+\\n'
+    """
+    with stats.current.phase("output"):
+        for name, strand, count, spans in rows:
+            end = f"\t{strand}\n" if strands else "\n"
+            if report == "count":
+                out.write(f"{name[0]}{name[1]}\t{count}{end}")
+            else:
+                for segment, left, right in spans:
+                    out.write(f"{name[0]}{name[1]}\t{segment}\t{left}\t{right}{end}")
 
 def getTrailingNumber(s):
     m = re.search(r'\d+$', s)
     return (s[:m.start()], int(s[m.start():]))
 
-def genomes_to_file(filename, genomes):
-    bwtList = preprocess_genomes(genomes)
-    outputFile = open(str(filename)+".dat", "wb")
-    pickle.dump(bwtList, outputFile)
+def preprocess_options(args):
+    """
+    Keyword arguments of build_matcher, and --max-memory, given on the command line
+    """
+    return {
+        "maxMemory": args.max_memory,
+        "saBuilder": args.sa,
+        "rankSample": args.rank_sample,
+        "saSample": args.sa_sample,
+        "saSampleMode": args.sa_sample_mode,
+        "kmerLength": args.kmer_length,
+        "reverseIndex": args.reverse_index,
+        "rankBackend": args.rank_backend,
+        "isaSample": args.isa_sample,
+    }
+
+def genomes_to_file(filename, genomes, jobs=1, maxMemory=None, **options):
+    """
+    Preprocesses the genome and writes its index. With maxMemory, the
+    records are built in segments within that many bytes and every segment
+    is written as soon as it is built, and the written index is returned.
+    """
+    genomeFingerprint = index.fingerprint(filename)
+    if maxMemory is None:
+        bwtList = preprocess_genomes(genomes, jobs, **options)
+    else:
+        bwtList = build_segments(genomes, maxMemory, jobs, **options)
+    with stats.current.phase("index_write"):
+        index.write_index(index_filename(filename), bwtList, genomeFingerprint)
+    if maxMemory is not None:
+        return load_index(index_filename(filename))
+    return bwtList
+
+def update_genomes_file(filename, genomes, jobs=1, maxMemory=None, **options):
+    """
+    Like genomes_to_file, but the BWTMatchers of the existing index whose
+    records are all still in the genome, unchanged, consecutive and in the
+    same order, and that were built with the same build_parameters are
+    copied as they are. Only the new and changed records (and the others of
+    a BWTMatcher that lost a record) are preprocessed again. The genome is
+    read once, holding at most the records of one old BWTMatcher while
+    checking that it can be copied, so with maxMemory the rebuilt records
+    are streamed into segments as in genomes_to_file.
+    """
+    genomeFingerprint = index.fingerprint(filename)
+    try:
+        old = load_index(index_filename(filename))
+    except (OSError, ValueError):
+        old = []
+    wanted = build_parameters(options)
+    candidates = [bwtMatcher for bwtMatcher in old if bwtMatcher.build == wanted and bwtMatcher.names]
+
+    reused = deque()
+    positions = deque()
+    remaining = unreused_records(genomes, candidates, reused, positions)
+    if maxMemory is None:
+        remaining = list(remaining)
+        built = build_matchers(remaining, jobs, **options) if remaining or not reused else []
+        bwtList = list(in_record_order(built, reused, positions))
+    else:
+        bwtList = in_record_order(build_segments(remaining, maxMemory, jobs, **options), reused, positions)
+    with stats.current.phase("index_write"):
+        index.write_index(index_filename(filename), bwtList, genomeFingerprint)
+    if maxMemory is not None:
+        return load_index(index_filename(filename))
     return bwtList
 
-def preprocess_genomes(genomes):
-    bwtList = []
+def unreused_records(genomes, candidates, reused, positions):
+    """
+    Yields the non-empty records of genomes that are not copied from one of
+    the candidate BWTMatchers, appending the position of every other record
+    to positions. A candidate is copied when all its records come next, in
+    its order; it is then appended to reused with the position of its first
+    record. Positions count the non-empty records from 0.
+    """
+    byFirst = {}
+    for bwtMatcher in candidates:
+        byFirst.setdefault((bwtMatcher.names[0], bwtMatcher.hashes[0]), bwtMatcher)
+    current = None
+    held = []
+    for position, gen in enumerate(gen for gen in genomes if len(gen[1]) > 0):
+        key = (gen[0], record_hash(gen[1]))
+        if current is None or key != (current.names[len(held)], current.hashes[len(held)]):
+            # The BWTMatcher being matched lost a record: its records are rebuilt
+            for start, record in held:
+                positions.append(start)
+                yield record
+            held = []
+            current = byFirst.get(key)
+            if current is None:
+                positions.append(position)
+                yield gen
+                continue
+        held.append((position, gen))
+        if len(held) == len(current.names):
+            reused.append((held[0][0], current))
+            del byFirst[(current.names[0], current.hashes[0])]
+            current = None
+            held = []
+    for start, record in held:
+        positions.append(start)
+        yield record
+
+def in_record_order(built, reused, positions):
+    """
+    Yields the BWTMatchers built from the records of unreused_records, in
+    order, with the reused ones before the first built BWTMatcher whose
+    first record comes after theirs
+    """
+    for bwtMatcher in built:
+        first = positions[0] if bwtMatcher.names else -1
+        for _ in bwtMatcher.names:
+            positions.popleft()
+        while reused and reused[0][0] < first:
+            yield reused.popleft()[1]
+        yield bwtMatcher
+    while reused:
+        yield reused.popleft()[1]
+
+def build_parameters(options):
+    """
+    The options of build_matcher that change the index it builds, with their
+    defaults, as stored with every BWTMatcher. The inverse suffix array is
+    sampled every sampling.DEFAULT_ISA_SAMPLE positions by default, except
+    with the runs backend, whose index would no longer be O(r): it is only
+    sampled there when isaSample is given.
+
+    >>> build_parameters({"rankSample": 16, "saBuilder": "radix"})["rankSample"], build_parameters({})["rankBackend"]
+    (16, 'auto')
+    >>> build_parameters({})["isaSample"], build_parameters({"rankBackend": "runs"})["isaSample"]
+    (32, 0)
+    """
+    defaults = inspect.signature(build_matcher).parameters
+    parameters = {name: options.get(name, defaults[name].default) for name in BUILD_PARAMETERS}
+    if parameters["isaSample"] is None:
+        runs = parameters["rankBackend"] == rank.RunLengthRankTable.KIND
+        parameters["isaSample"] = 0 if runs else sampling.DEFAULT_ISA_SAMPLE
+    return parameters
+
+def index_filename(genomeFilename):
+    return str(genomeFilename)+".fmi"
+
+def index_is_fresh(genomeFilename):
+    """
+    Checks that the index of genomeFilename can be read and was built from
+    the current version of the file, by comparing fingerprints
+    """
+    try:
+        meta = index.read_metadata(index_filename(genomeFilename))
+    except (OSError, ValueError):
+        return False
+    genomeFingerprint = index.fingerprint(genomeFilename)
+    return genomeFingerprint is not None and meta["fingerprint"] == genomeFingerprint
+
+def ensure_index(genomeFilename, **options):
+    """
+    Updates the index of genomeFilename if it is missing or stale and
+    returns its file name
+    """
+    with stats.current.phase("index_check"):
+        fresh = index_is_fresh(genomeFilename)
+    if not fresh:
+        with readers.open_text(genomeFilename) as genomeFile:
+            update_genomes_file(genomeFilename, fasta.fasta_parse(genomeFile), **options)
+    return index_filename(genomeFilename)
+
+def load_index(filename):
+    """
+    Memory-maps a preprocessed genome written by genomes_to_file
+    """
+    return [BWTMatcher(**parts) for parts in index.read_index(filename)]
+
+def preprocess_genomes(genomes, jobs=1, **options):
+    """
+    Builds the BWTMatchers of a genome; options are passed on to build_matcher
+    """
+    records = [gen for gen in genomes if len(gen[1]) > 0]
+    return build_matchers(records, jobs, **options)
+
+def build_matchers(records, jobs=1, **options):
+    """
+    Builds one BWTMatcher over the records, or with jobs > 1 splits them in
+    up to jobs parts of about the same length and builds those in parallel
+    """
+    parts = partition_records(records, jobs)
+    if len(parts) <= 1:
+        return [build_matcher(records, **options)]
+    with multiprocessing.Pool(len(parts)) as pool, stats.current.phase("build_parallel"):
+        return pool.starmap(_build_part, [(part, options) for part in parts])
+
+def _build_part(records, options):
+    return build_matcher(records, **options)
+
+def build_segments(genomes, maxMemory, jobs=1, **options):
+    """
+    Yields the BWTMatchers of the genome records one segment at a time, so
+    that only the records of jobs segments, and what building them takes,
+    are in memory at once. Segments are as many consecutive records as
+    can be built in maxMemory / jobs bytes, spilling the suffix arrays to
+    disk. Records are never split, so a record that is larger on its own
+    gets a segment to itself, with a warning that it takes more than that.
+    """
+    maxBases = segment_bases(maxMemory, jobs)
+    segments = warn_oversized(segment_records(genomes, maxBases), maxBases)
+    if jobs <= 1:
+        for part in segments:
+            yield build_matcher(part, spill=True, **options)
+        return
+    options = dict(options, spill=True)
+    with multiprocessing.Pool(jobs) as pool:
+        for group in batched(segments, jobs):
+            with stats.current.phase("build_parallel"):
+                built = pool.starmap(_build_part, [(part, options) for part in group])
+            yield from built
+
+def segment_bases(maxMemory, jobs=1):
+    """
+    Number of bases of a segment, of which jobs are built at a time in
+    maxMemory bytes besides BUILD_BASELINE_BYTES
+
+    >>> segment_bases(BUILD_BASELINE_BYTES + 360 * BUILD_BYTES_PER_BASE, 2)
+    180
+    """
+    return max((maxMemory - BUILD_BASELINE_BYTES) // jobs // BUILD_BYTES_PER_BASE, 1)
+
+def warn_oversized(segments, maxBases):
+    """
+    Passes the segments of segment_records on, warning on standard error
+    about the records that are longer than maxBases on their own
+    """
+    for part in segments:
+        if len(part) == 1 and len(part[0][1]) > maxBases:
+            name, sequence = part[0]
+            needed = BUILD_BASELINE_BYTES + len(sequence) * BUILD_BYTES_PER_BASE
+            sys.stderr.write(f"fm: warning: record {name} has {len(sequence)} bases, more than the {maxBases} "
+                             f"that fit in --max-memory; building it takes about {needed >> 20}M\n")
+        yield part
+
+def segment_records(genomes, maxBases):
+    """
+    Groups the non-empty records into consecutive segments of at most
+    maxBases bases, except for records longer than that on their own
+
+    >>> [[gen[0] for gen in part] for part in segment_records([["a", "x" * 5], ["b", "x"], ["c", ""], ["d", "x" * 4]], 6)]
+    [['a', 'b'], ['d']]
+    """
+    part = []
+    size = 0
     for gen in genomes:
-        string = gen[1]+"$"
-        alphadic = {a: i for i, a in enumerate(set(string))}
-
-        x = memoryview(string.encode())
-        suf = getSuffixes(x)
-        f = radix_sort(suf)
-        bwt = [(i-1)%len(f) for i in f]
-        rank_table = build_rank_table(x, alphadic, bwt)
+        if len(gen[1]) == 0:
+            continue
+        if part and size + len(gen[1]) > maxBases:
+            yield part
+            part = []
+            size = 0
+        part.append(gen)
+        size += len(gen[1])
+    if part:
+        yield part
+
+def partition_records(records, parts):
+    """
+    Splits the records in at most the given number of consecutive groups of
+    about the same total length
+
+    >>> [[gen[0] for gen in part] for part in partition_records([["a", "x" * 5], ["b", "x"], ["c", "x" * 4]], 2)]
+    [['a'], ['b', 'c']]
+    """
+    total = sum(len(gen[1]) for gen in records)
+    groups = []
+    position = 0
+    for gen in records:
+        group = min(position * parts // max(total, 1), parts - 1)
+        if not groups or group > groups[-1][0]:
+            groups.append((group, []))
+        groups[-1][1].append(gen)
+        position += len(gen[1])
+    return [group for _, group in groups]
+
+def build_matcher(records, saBuilder="sais", rankSample=rank.DEFAULT_SAMPLE_RATE,
+                  saSample=1, saSampleMode="text", kmerLength=0, reverseIndex=False, rankBackend="auto",
+                  spill=False, isaSample=None):
+    """
+    Builds one FM-index over all the records, joined by SEPARATOR. With
+    spill, the suffix arrays are moved to temporary files as soon as they
+    are built, and what is derived from them is read back a block at a time.
+    The inverse suffix array is sampled every isaSample positions, see
+    build_parameters for its default, and not at all for 0.
+    """
+    build = build_parameters(locals())
+    isaSample = build["isaSample"]
+    names = [gen[0] for gen in records]
+    starts = []
+    position = 0
+    for gen in records:
+        starts.append(position)
+        position += len(gen[1]) + len(SEPARATOR)
+
+    string = SEPARATOR.join(gen[1] for gen in records)+"$"
+    x = memoryview(string.encode())
+    alphadic = getAlphabet(x)
+    stats.current.count("records", len(records))
+    stats.current.count("genome_bases", len(x) - 1)
+    letters = getLetters(alphadic)
+    # Checked before the suffix array is built, which is the slow part;
+    # with no letters at all there is no k-mer to store
+    kmerLength = kmerLength if letters else 0
+    if kmerLength > 0:
+        kmers.check_table_size(kmerLength, len(letters))
+
+    with stats.current.phase("sa_build"):
+        f = suffix_array_buffer(SA_BUILDERS[saBuilder](x), spill)
+    with stats.current.phase("rank_build"):
+        rank_table = build_rank_table(x, alphadic, f, rankSample, rankBackend)
         firstIndexList = getFirstIndexList(x, f, alphadic)
-        bwtList.append(BWTMatcher(f, rank_table, firstIndexList, alphadic))
-    return bwtList
+    with stats.current.phase("sa_sample"):
+        if rank_table.KIND == rank.RunLengthRankTable.KIND:
+            sampledSA = sampling.RunSampledSuffixArray(f, rank_table)
+        else:
+            sampledSA = sampling.SampledSuffixArray(f, saSample, saSampleMode)
+        isa = sampling.SampledInverseSuffixArray(f, isaSample) if isaSample > 0 else None
+    kmerTable = None
+    if kmerLength > 0:
+        with stats.current.phase("kmer_build"):
+            codes = batch.code_table(alphadic)[np.frombuffer(x, dtype=np.uint8)]
+            kmerTable = kmers.build_kmer_table(kmerLength, codes, f, letters)
+    reverse_rank_table = None
+    if reverseIndex:
+        with stats.current.phase("reverse_build"):
+            reverse = memoryview((string[-2::-1]+"$").encode())
+            fr = suffix_array_buffer(SA_BUILDERS[saBuilder](reverse), spill)
+            reverse_rank_table = build_rank_table(reverse, alphadic, fr, rankSample, rankBackend)
+    return BWTMatcher(sampledSA, rank_table, firstIndexList, alphadic, names, sampling.sample_array(starts, len(f)),
+                      kmerTable, reverse_rank_table, [record_hash(gen[1]) for gen in records], isa, build)
+
+def record_hash(sequence):
+    return hashlib.blake2b(sequence.encode(), digest_size=16).hexdigest()
+
+def sais_suffix_array(x):
+    """
+    Builds the suffix array of x (ending in the sentinel) in O(n) with SA-IS
+
+    >>> sais_suffix_array(memoryview(b"mississippi$"))
+    [11, 10, 7, 4, 1, 0, 9, 8, 6, 3, 5, 2]
+    """
+    codes, sigma = sais.encode_text(x)
+    return sais.sais(codes, sigma)
+
+def radix_suffix_array(x):
+    """
+    Reference O(n^2) construction by radix sorting every suffix of x.
+    Only meant for cross-checking the other builders on small inputs. The
+    symbols are sorted by their codes, so the sentinel comes first as in
+    SA-IS even when SEPARATOR is a smaller byte.
+
+    >>> radix_suffix_array(memoryview(b"mississippi$"))
+    [11, 10, 7, 4, 1, 0, 9, 8, 6, 3, 5, 2]
+    >>> radix_suffix_array(memoryview(b"ac\\nca\\nac$"))[:3]
+    [8, 5, 2]
+    """
+    codes, _ = sais.encode_text(x)
+    return radix_sort(getSuffixes(codes))
+
+SA_BUILDERS = {
+    "sais": sais_suffix_array,
+    "radix": radix_suffix_array,
+}
 
 def getSuffixes(x):
     """
@@ -137,20 +1182,63 @@ def counting_sort(lst: list[memoryview], place):
         ordered += counts[key]
     return ordered
 
-def build_rank_table(x, alphadic, bwt):
-    table = [[0 for _ in alphadic] for _ in range(0, len(bwt)+1)]
+def getAlphabet(x):
+    """
+    Maps every symbol of x to its code, in alphabetical order and with the
+    sentinel (the last symbol of x) as code 0
 
-    for i in range(1, len(bwt)+1):        
-        for j in range(0, len(alphadic)):
-            table[i][j] = table[i-1][j]
-        
-        bwtValue = bwt[i-1]
-        c = chr(x[bwtValue])
+    >>> getAlphabet(memoryview(b"mississippi$"))
+    {'$': 0, 'i': 1, 'm': 2, 'p': 3, 's': 4}
+    """
+    alphadic = {chr(x[-1]): 0}
+    for i, a in enumerate(sorted(set(x[:-1]))):
+        alphadic[chr(a)] = i + 1
+    return alphadic
+
+def getLetters(alphadic):
+    """
+    Maps the code of every letter that can be part of a read (so not the
+    sentinel or SEPARATOR) to its index among them
+
+    >>> getLetters({'$': 0, '\\n': 1, 'a': 2, 'c': 3})
+    {2: 0, 3: 1}
+    """
+    letters = [c for a, c in alphadic.items() if c != 0 and a != SEPARATOR]
+    return {c: i for i, c in enumerate(letters)}
+
+def suffix_array_buffer(f, spill=False):
+    """
+    The suffix array built as a list as a numpy array, so the list can be
+    freed, or with spill as a numpy.memmap of a temporary file, filled a
+    block at a time
+    """
+    n = len(f)
+    dtype = np.uint32 if n < 2**32 else np.uint64
+    if not spill:
+        return np.asarray(f, dtype=dtype)
+    spilled = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode="w+", shape=(n,))
+    for start in range(0, n, SPILL_BLOCK):
+        spilled[start:start + SPILL_BLOCK] = f[start:start + SPILL_BLOCK]
+    return spilled
 
-        index = alphadic.get(c)
-        table[i][index] += 1
+def build_rank_table(x, alphadic, f, k=rank.DEFAULT_SAMPLE_RATE, backend="auto"):
+    """
+    Builds the rank structure for the BWT of x, given its suffix array. The
+    BWT is computed a block of the suffix array at a time.
 
-    return table
+    >>> x = memoryview(b"mississippi$")
+    >>> alphadic = getAlphabet(x)
+    >>> table = build_rank_table(x, alphadic, sais_suffix_array(x))
+    >>> "".join(list(alphadic)[table[i]] for i in range(len(x)))
+    'ipssm$pissii'
+    """
+    n = len(x)
+    text = batch.code_table(alphadic)[np.frombuffer(x, dtype=np.uint8)]
+    codes = np.empty(n, dtype=np.uint8)
+    for start in range(0, n, SPILL_BLOCK):
+        rows = np.asarray(f[start:start + SPILL_BLOCK], dtype=np.int64)
+        codes[start:start + len(rows)] = text[(rows - 1) % n]
+    return rank.rank_table_for(codes.tobytes(), len(alphadic), k, backend)
 
 def getFirstIndexList(x, f, alphadic):
     firstIndexList = {a: -1 for a in alphadic}
@@ -169,23 +1257,163 @@ def getFirstIndexList(x, f, alphadic):
 
 
 def getrank(alphadic, index, c, rank_table):
-    return rank_table[index][alphadic.get(c)]
+    return rank_table.rank(alphadic.get(c), index)
+
+def lf(bwtMatcher, row):
+    """
+    Maps a row of the BWT to the row of the suffix starting one position earlier
+    """
+    c = bwtMatcher.rank_table[row]
+    return bwtMatcher.C[c] + bwtMatcher.rank_table.rank(c, row)
+
+def locate(bwtMatcher, row):
+    """
+    Suffix array value at row, walking LF until a sampled row is found
+    """
+    steps = 0
+    value = bwtMatcher.f.lookup(row)
+    while value is None:
+        row = lf(bwtMatcher, row)
+        steps += 1
+        value = bwtMatcher.f.lookup(row)
+    return (value + steps) % len(bwtMatcher.f)
+
+def extract_text(bwtMatcher, start, end):
+    """
+    The joined text[start:end], rebuilt from the BWT by LF-mapping back from
+    the first sampled inverse suffix array position at or after end
+    """
+    rank_table = bwtMatcher.rank_table
+    C = bwtMatcher.C
+    position, row = bwtMatcher.isa.anchor(end)
+    codes = []
+    while position > start:
+        c = rank_table[row]
+        position -= 1
+        if position < end:
+            codes.append(c)
+        if position > start:
+            row = C[c] + rank_table.rank(c, row)
+    letters = bwtMatcher.letters
+    return "".join(letters[c] for c in reversed(codes))
+
+def extract(bwtList, chrom, start=0, end=None):
+    """
+    The letters [start, end) of the record chrom (or up to its end), from
+    the index alone. chrom is the name of the record or its first word.
+
+    >>> bwtList = preprocess_genomes([["chr1 first", "mississippi"], ["chr2", "acgtacgt"]], isaSample=4)
+    >>> extract(bwtList, "chr1", 2, 7), extract(bwtList, "chr2", 5), extract(bwtList, "chr1", 3, 3)
+    ('ssiss', 'cgt', '')
+    """
+    for bwtMatcher in bwtList:
+        for i, name in enumerate(bwtMatcher.names):
+            if name == chrom or name.split(maxsplit=1)[:1] == [chrom]:
+                length = bwtMatcher.chromosome_length(i)
+                if end is None:
+                    end = length
+                if not 0 <= start <= end <= length:
+                    raise ValueError(f"{chrom}:{start + 1}-{end} is outside of {chrom} (length {length})")
+                if bwtMatcher.isa is None:
+                    raise ValueError(f"the index of {chrom} has no inverse suffix array samples, "
+                                     "preprocess the genome again with --isa-sample")
+                offset = bwtMatcher.starts[i]
+                return extract_text(bwtMatcher, offset + start, offset + end)
+    raise ValueError(f"no record named {chrom!r} in the index")
+
+def parse_region(text):
+    """
+    (record, start, end) of a region written chrom, chrom:start or
+    chrom:start-end, 1-based and inclusive as in samtools faidx; end is None
+    for the end of the record
+
+    >>> parse_region("chr1:1,001-2,000"), parse_region("chr2:5"), parse_region("chrM")
+    (('chr1', 1000, 2000), ('chr2', 4, None), ('chrM', 0, None))
+    """
+    chrom, colon, span = text.rpartition(":")
+    if not colon:
+        return text, 0, None
+    first, dash, last = span.replace(",", "").partition("-")
+    try:
+        return chrom, int(first) - 1, int(last) if dash else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid region: {text!r}")
+
+def toehold_search(p, bwtMatcher):
+    """
+    Backward search of p in a run-length index, which also follows the
+    suffix array value at the last row of the interval: it is one less than
+    the value at the last row of the previous interval if that row has the
+    letter, or else at the end of the last run of the letter before it.
+    Returns (left, right, value), or None if p does not occur.
+    """
+    runs = bwtMatcher.rank_table
+    sa = bwtMatcher.f
+    left, right = 0, len(sa)
+    value = sa.samples[runs.runs - 1]
+    for a in reversed(p):
+        c = bwtMatcher.alphadic.get(a)
+        if c is None:
+            return None
+        k = runs.run_of(right - 1)
+        if runs.run_symbols[k] == c:
+            value -= 1
+        else:
+            k = runs.last_run(c, k)
+            if k is None:
+                return None
+            value = sa.samples[k] - 1
+        left = bwtMatcher.C[c] + runs.rank(c, left)
+        right = bwtMatcher.C[c] + runs.rank(c, right)
+        if left >= right:
+            return None
+    return left, right, value
+
+def locate_interval(bwtMatcher, left, right, toehold=None, p=None, limit=None):
+    """
+    Suffix array values of the rows [left, right), or of limit of them. If
+    the index is run-length encoded and the value at the last row (the
+    toehold) is known, or p is the pattern whose interval it is, they are
+    found with phi from the toehold instead of row by row, so the limit
+    keeps the last rows instead of the first ones.
+    """
+    if bwtMatcher.f.mode != "runs" or (toehold is None and p is None):
+        if limit is not None:
+            right = min(right, left + limit)
+        return [locate(bwtMatcher, row) for row in range(left, right)]
+    if limit is not None:
+        left = max(left, right - limit)
+    if left >= right:
+        return []
+    value = toehold if toehold is not None else toehold_search(p, bwtMatcher)[2]
+    values = [value]
+    for _ in range(right - left - 1):
+        value = bwtMatcher.f.phi(value)
+        values.append(value)
+    return values[::-1]
 
 def searchPattern(p, bwtMatcher):
     if p == "":
         return
+    pattern = p
     
+    occ = bwtMatcher.rank_table.rank
     left, right = 0, len(bwtMatcher.f)
+    kmerTable = bwtMatcher.kmers
+    if kmerTable is not None and len(p) >= kmerTable.k:
+        left, right = kmerTable.interval([bwtMatcher.alphadic.get(a) for a in p[-kmerTable.k:]])
+        if left >= right: return  # no matches
+        p = p[:-kmerTable.k]
     for a in reversed(p):
-        if a not in bwtMatcher.alphadic:
+        c = bwtMatcher.alphadic.get(a)
+        if c is None:
             return
-        left = bwtMatcher.firstIndexList[a] + bwtMatcher.rank_table[left][bwtMatcher.alphadic.get(a)]
-        right = bwtMatcher.firstIndexList[a] + bwtMatcher.rank_table[right][bwtMatcher.alphadic.get(a)]
+        left = bwtMatcher.firstIndexList[a] + occ(c, left)
+        right = bwtMatcher.firstIndexList[a] + occ(c, right)
         if left >= right: return  # no matches
 
     # Report the matches
-    for i in range(left, right):
-        yield bwtMatcher.f[i]    
+    yield from locate_interval(bwtMatcher, left, right, p=pattern)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
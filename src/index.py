@@ -0,0 +1,268 @@
+"""
+Binary on-disk format for preprocessed genomes.
+
+The file starts with a fixed header, followed by raw little-endian arrays
+aligned to 8 bytes and finally a JSON block describing every record. A record
+is one FM-index over one or more chromosomes joined together; the JSON block
+holds its chromosome names, alphabet, sampling parameters and the offset,
+type and length of each of its arrays (including the chromosome start table
+and the inverse suffix array samples that text is extracted from):
+
+    offset  size  field
+    0       8     magic, b"FMINDEX\\0"
+    8       4     format version (uint32)
+    12      4     number of records (uint32)
+    16      8     offset of the JSON block (uint64)
+    24      8     length of the JSON block (uint64)
+    32      ...   arrays
+
+The search path maps the file with mmap and builds the rank and suffix
+array structures directly on top of the mapped pages, so nothing but the
+small JSON block is parsed when loading.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+import rank
+import sampling
+import kmers
+
+MAGIC = b"FMINDEX\0"
+VERSION = 8
+HEADER = struct.Struct("<8sIIQQ")
+ALIGNMENT = 8
+# Bytes at the start of the genome file hashed into its fingerprint
+FINGERPRINT_BLOCK = 1 << 16
+
+class MappedBytes:
+    """
+    Read-only window into a mapped file that behaves like the bytes objects
+    the rank tables expect: integer indexing, slicing and count().
+    """
+    def __init__(self, mm, offset, length):
+        self.mm = mm
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            return self.mm[self.offset + start:self.offset + stop:step]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("index out of range")
+        return self.mm[self.offset + i]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.frombuffer(self.mm, dtype=np.uint8, count=self.length, offset=self.offset)
+
+    def count(self, c, start=0, end=None):
+        if end is None:
+            end = self.length
+        return self.mm[self.offset + start:self.offset + end].count(c)
+
+class _Writer:
+    def __init__(self, file):
+        self.file = file
+        self.position = HEADER.size
+        file.write(b"\0" * HEADER.size)
+
+    def add(self, values, dtype):
+        """
+        Writes values as a little-endian array and returns its description
+        """
+        data = np.asarray(values, dtype=dtype)
+        padding = -self.position % ALIGNMENT
+        self.file.write(b"\0" * padding)
+        self.position += padding
+        description = {"offset": self.position, "dtype": dtype, "count": len(data)}
+        raw = data.tobytes()
+        self.file.write(raw)
+        self.position += len(raw)
+        return description
+
+def fingerprint(genomeFilename):
+    """
+    Cheap fingerprint of a genome file: its size, modification time and a
+    hash of its first block. None if the file can not be read.
+    """
+    try:
+        stat = os.stat(genomeFilename)
+        with open(genomeFilename, "rb") as file:
+            head = hashlib.blake2b(file.read(FINGERPRINT_BLOCK), digest_size=16).hexdigest()
+    except OSError:
+        return None
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "head": head}
+
+def write_index(filename, bwtList, genomeFingerprint=None):
+    """
+    Writes the BWTMatchers of every record of a genome to filename, along
+    with the fingerprint of the genome file they were built from
+    """
+    records = []
+    # Written next to the old index and moved over it at the end, so the old
+    # one stays valid for anyone mapping it (or copying from it) meanwhile
+    temporary = f"{filename}.tmp"
+    with open(temporary, "wb") as file:
+        writer = _Writer(file)
+        for bwtMatcher in bwtList:
+            rank_table = bwtMatcher.rank_table
+            sa = bwtMatcher.f
+            saType = "<u4" if sa.samples.itemsize == 4 else "<u8"
+            arrays = {
+                "C": writer.add(bwtMatcher.C, "<u8"),
+                "samples": writer.add(sa.samples, saType),
+                "starts": writer.add(bwtMatcher.starts, "<u8"),
+            }
+            for name, (values, dtype) in rank_table.arrays().items():
+                arrays[name] = writer.add(values, dtype)
+            isa = bwtMatcher.isa
+            if isa is not None:
+                arrays["isa_samples"] = writer.add(isa.samples, "<u4" if isa.samples.itemsize == 4 else "<u8")
+            if sa.mode == "runs":
+                arrays["heads"] = writer.add(sa.heads, saType)
+                arrays["previous"] = writer.add(sa.previous, saType)
+            if sa.marks is not None:
+                arrays["marks_words"] = writer.add(sa.marks.words, "<u8")
+                arrays["marks_ranks"] = writer.add(sa.marks.ranks, "<u8")
+            kmerTable = bwtMatcher.kmers
+            if kmerTable is not None:
+                arrays["kmer_left"] = writer.add(kmerTable.left, "<u4" if kmerTable.left.itemsize == 4 else "<u8")
+                arrays["kmer_right"] = writer.add(kmerTable.right, "<u4" if kmerTable.right.itemsize == 4 else "<u8")
+            reverse_rank_table = bwtMatcher.reverse_rank_table
+            if reverse_rank_table is not None:
+                for name, (values, dtype) in reverse_rank_table.arrays().items():
+                    arrays["reverse_" + name] = writer.add(values, dtype)
+            records.append({
+                "names": bwtMatcher.names,
+                "hashes": bwtMatcher.hashes,
+                "lengths": [int(bwtMatcher.chromosome_length(i)) for i in range(len(bwtMatcher.names))],
+                "alphabet": list(bwtMatcher.alphadic),
+                "n": len(sa),
+                "k": rank_table.k,
+                "rank": rank_table.KIND,
+                "reverse_rank": reverse_rank_table.KIND if reverse_rank_table is not None else None,
+                "s": sa.s,
+                "mode": sa.mode,
+                "isa_s": isa.s if isa is not None else 0,
+                "kmer_k": kmerTable.k if kmerTable is not None else 0,
+                "kmer_letters": sorted(kmerTable.letters) if kmerTable is not None else [],
+                "build": bwtMatcher.build,
+                "arrays": arrays,
+            })
+        meta = json.dumps({"fingerprint": genomeFingerprint, "records": records}).encode()
+        metaOffset = writer.position
+        file.write(meta)
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, len(records), metaOffset, len(meta)))
+    os.replace(temporary, filename)
+
+def _view(mm, description):
+    """
+    Zero-copy view of an array in the mapped file, indexable from Python
+    """
+    dtype = np.dtype(description["dtype"])
+    array = np.frombuffer(mm, dtype=dtype, count=description["count"], offset=description["offset"])
+    if not dtype.isnative:
+        array = array.astype(dtype.newbyteorder("="))
+    return memoryview(array)
+
+def _rank_table(mm, arrays, prefix, kind, record, sigma):
+    """
+    Rank structure of the given kind over the arrays whose names start with prefix
+    """
+    table = rank.RANK_TABLES[kind]
+    buffers = {}
+    for name in table.ARRAYS:
+        description = arrays[prefix + name]
+        if description["dtype"] == "u1":
+            buffers[name] = MappedBytes(mm, description["offset"], description["count"])
+        else:
+            buffers[name] = _view(mm, description)
+    return table.from_arrays(buffers, record["n"], sigma, record["k"])
+
+def _map(filename):
+    """
+    Maps filename and returns the mapping and the parsed JSON block
+    """
+    with open(filename, "rb") as file:
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(mm) < HEADER.size:
+        raise ValueError(f"{filename} is not a preprocessed genome")
+    magic, version, count, metaOffset, metaLength = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a preprocessed genome")
+    if version != VERSION:
+        raise ValueError(f"{filename} has index format version {version}, expected {VERSION}")
+    return mm, json.loads(mm[metaOffset:metaOffset + metaLength])
+
+def read_metadata(filename):
+    """
+    The fingerprint and the record names and lengths of an index, without
+    touching its arrays
+    """
+    mm, meta = _map(filename)
+    mm.close()
+    return meta
+
+def read_index(filename):
+    """
+    Maps filename and returns, for every record, the keyword arguments of
+    its BWTMatcher
+    """
+    mm, meta = _map(filename)
+    records = meta["records"]
+
+    out = []
+    for record in records:
+        arrays = record["arrays"]
+        alphadic = {a: i for i, a in enumerate(record["alphabet"])}
+        C = _view(mm, arrays["C"])
+        firstIndexList = {a: C[i] for a, i in alphadic.items()}
+
+        rank_table = _rank_table(mm, arrays, "", record["rank"], record, len(alphadic))
+
+        if record["mode"] == "runs":
+            sa = sampling.RunSampledSuffixArray.from_buffers(record["n"], rank_table, _view(mm, arrays["samples"]),
+                                                             _view(mm, arrays["heads"]), _view(mm, arrays["previous"]))
+        else:
+            marks = None
+            if "marks_words" in arrays:
+                marks = rank.BitVector.from_buffers(record["n"], _view(mm, arrays["marks_words"]), _view(mm, arrays["marks_ranks"]))
+            sa = sampling.SampledSuffixArray.from_buffers(record["n"], record["s"], record["mode"], _view(mm, arrays["samples"]), marks)
+
+        isa = None
+        if "isa_samples" in arrays:
+            isa = sampling.SampledInverseSuffixArray.from_buffers(record["n"], record["isa_s"], _view(mm, arrays["isa_samples"]))
+
+        kmerTable = None
+        if record["kmer_k"] > 0:
+            letters = {c: i for i, c in enumerate(record["kmer_letters"])}
+            kmerTable = kmers.KmerTable(record["kmer_k"], letters, _view(mm, arrays["kmer_left"]), _view(mm, arrays["kmer_right"]))
+
+        reverse_rank_table = None
+        if record["reverse_rank"] is not None:
+            reverse_rank_table = _rank_table(mm, arrays, "reverse_", record["reverse_rank"], record, len(alphadic))
+
+        out.append({
+            "f": sa,
+            "rank_table": rank_table,
+            "firstIndexList": firstIndexList,
+            "alphadic": alphadic,
+            "names": record["names"],
+            "starts": _view(mm, arrays["starts"]),
+            "kmerTable": kmerTable,
+            "reverse_rank_table": reverse_rank_table,
+            "hashes": record["hashes"],
+            "isa": isa,
+            "build": record.get("build"),
+        })
+    return out
@@ -0,0 +1,123 @@
+from array import array
+import numpy as np
+
+# Largest number of k-mers a table may hold, 2 arrays of 4^12 uint32 = 128 MiB
+MAX_ENTRIES = 4**12
+
+class KmerTable:
+    """
+    Suffix array interval of every k-mer over the letters of the genome.
+
+    The k-mers are numbered in base len(letters), in the same order as their
+    codes, so the table is just two flat arrays with the left and right end
+    of each interval ((0, 0) for the k-mers that do not occur).
+    """
+    def __init__(self, k, letters, left, right):
+        self.k = k
+        # Symbol code -> digit of the k-mer number, for the symbols that are letters
+        self.letters = letters
+        self.left = left
+        self.right = right
+
+    def number(self, codes):
+        """
+        Number of the k-mer with the given symbol codes, or None if one of them is not a letter
+        """
+        number = 0
+        for c in codes:
+            digit = self.letters.get(c)
+            if digit is None:
+                return None
+            number = number * len(self.letters) + digit
+        return number
+
+    def interval(self, codes):
+        number = self.number(codes)
+        if number is None:
+            return 0, 0
+        return self.left[number], self.right[number]
+
+    def intervals_many(self, codes):
+        """
+        Vectorized interval: the rows of codes are k-mers given as symbol codes
+        """
+        digits = np.full(256, -1, dtype=np.int64)
+        for c, digit in self.letters.items():
+            digits[c] = digit
+        rowDigits = digits[codes]
+        valid = (rowDigits >= 0).all(axis=1)
+        powers = len(self.letters) ** np.arange(self.k - 1, -1, -1, dtype=np.int64)
+        numbers = np.where(valid, rowDigits @ powers, 0)
+        left = np.where(valid, np.asarray(self.left)[numbers], 0).astype(np.int64)
+        right = np.where(valid, np.asarray(self.right)[numbers], 0).astype(np.int64)
+        return left, right
+
+    def nbytes(self):
+        return self.left.itemsize * len(self.left) + self.right.itemsize * len(self.right)
+
+def check_table_size(k, sigma):
+    """
+    The number of entries of a table of k-mers over sigma letters, which
+    raises ValueError if it is larger than MAX_ENTRIES
+
+    >>> check_table_size(12, 4)
+    16777216
+    >>> check_table_size(11, 5)
+    Traceback (most recent call last):
+    ...
+    ValueError: a table of 11-mers over 5 letters would need 48828125 entries, at most 16777216 are allowed
+    """
+    entries = sigma**k
+    if entries > MAX_ENTRIES:
+        raise ValueError(f"a table of {k}-mers over {sigma} letters would need {entries} entries, "
+                         f"at most {MAX_ENTRIES} are allowed")
+    return entries
+
+def build_kmer_table(k, codes, f, letters):
+    """
+    Builds the table from the encoded text, its suffix array and the codes of
+    the letters. A row of the suffix array belongs to a k-mer when the first
+    k symbols of its suffix are all letters; since the rows are sorted, the
+    rows of each k-mer are consecutive.
+
+    >>> table = build_kmer_table(2, [2, 1, 3, 3, 1, 3, 3, 1, 0], [8, 7, 4, 1, 0, 6, 3, 5, 2], {1: 0, 2: 1, 3: 2})
+    >>> table.interval([1, 3]), table.interval([3, 3]), table.interval([3, 2])
+    ((2, 4), (7, 9), (0, 0))
+    """
+    sigma = len(letters)
+    entries = check_table_size(k, sigma)
+
+    digits = np.full(max(letters, default=0) + 1, -1, dtype=np.int64)
+    for c, digit in letters.items():
+        digits[c] = digit
+    text = np.asarray(codes, dtype=np.int64)
+    text = np.where(text < len(digits), digits[np.minimum(text, len(digits) - 1)], -1)
+
+    # Number of the k-mer starting at every text position, -1 if it does not fit or has a non-letter
+    n = len(text)
+    numbers = np.zeros(max(n - k + 1, 0), dtype=np.int64)
+    valid = np.ones(len(numbers), dtype=bool)
+    for j in range(k):
+        window = text[j:j + len(numbers)]
+        valid &= window >= 0
+        numbers = numbers * sigma + np.maximum(window, 0)
+    numbers = np.where(valid, numbers, -1)
+
+    f = np.asarray(f, dtype=np.int64)
+    rowNumbers = np.full(n, -1, dtype=np.int64)
+    inRange = f < len(numbers)
+    rowNumbers[inRange] = numbers[f[inRange]]
+    rows = np.nonzero(rowNumbers >= 0)[0]
+    sortedNumbers = rowNumbers[rows]
+
+    dtype = np.uint32 if n < 2**32 else np.uint64
+    left = np.zeros(entries, dtype=dtype)
+    right = np.zeros(entries, dtype=dtype)
+    present, firsts, counts = np.unique(sortedNumbers, return_index=True, return_counts=True)
+    left[present] = rows[firsts]
+    right[present] = rows[firsts] + counts
+    typecode = "I" if dtype == np.uint32 else "Q"
+    leftArray, rightArray = array(typecode), array(typecode)
+    leftArray.frombytes(left.tobytes())
+    rightArray.frombytes(right.tobytes())
+    return KmerTable(k, letters, leftArray, rightArray)
@@ -0,0 +1,716 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import cached_property
+import numpy as np
+
+DEFAULT_SAMPLE_RATE = 64
+# Symbols per byte of a PackedRankTable
+PACKED_SYMBOLS = 4
+
+class RankTable:
+    """
+    Occ/rank structure over an integer-encoded BWT.
+
+    Instead of one row of counters per BWT position, the counts of every
+    symbol are only stored every k positions (the checkpoints) in a flat
+    uint32 array. The BWT is kept as one byte per symbol, so the rank at any
+    other position is the closest checkpoint plus a scan of at most k-1 bytes.
+    """
+    KIND = "plain"
+    # Names of the arrays stored in the index
+    ARRAYS = ("bwt", "checkpoints")
+
+    def __init__(self, bwt, sigma, k=DEFAULT_SAMPLE_RATE):
+        self.bwt = bytes(bwt)
+        self.sigma = sigma
+        self.k = k
+        self.checkpoints = build_checkpoints(self.bwt, sigma, k)
+
+    @classmethod
+    def from_buffers(cls, bwt, checkpoints, sigma, k):
+        """
+        Wraps already built buffers, e.g. views into a memory-mapped index
+        """
+        table = cls.__new__(cls)
+        table.bwt = bwt
+        table.checkpoints = checkpoints
+        table.sigma = sigma
+        table.k = k
+        return table
+
+    @classmethod
+    def from_arrays(cls, arrays, n, sigma, k):
+        return cls.from_buffers(arrays["bwt"], arrays["checkpoints"], sigma, k)
+
+    def arrays(self):
+        """
+        The arrays to store in the index and their types
+        """
+        return {"bwt": (self.bwt_array, "u1"), "checkpoints": (self.checkpoints, "<u4")}
+
+    def __len__(self):
+        return len(self.bwt)
+
+    def __getitem__(self, i):
+        return self.bwt[i]
+
+    def rank(self, c, i):
+        """
+        Number of occurrences of the symbol c in bwt[:i]
+
+        >>> RankTable(b"\\x01\\x02\\x00\\x01\\x01", 3, k=2).rank(1, 4)
+        2
+        """
+        block = i // self.k
+        r = self.checkpoints[block * self.sigma + c]
+        start = block * self.k
+        if start < i:
+            r += self.bwt.count(c, start, i)
+        return r
+
+    def nbytes(self):
+        return len(self.bwt) + self.checkpoints.itemsize * len(self.checkpoints)
+
+    @staticmethod
+    def nbytes_for(n, sigma, k):
+        """
+        Size of the table of a BWT of length n
+        """
+        return n + 4 * sigma * (n // k + 1)
+
+    @cached_property
+    def bwt_array(self):
+        if isinstance(self.bwt, (bytes, bytearray, memoryview)):
+            return np.frombuffer(self.bwt, dtype=np.uint8)
+        return np.asarray(self.bwt)
+
+    @cached_property
+    def checkpoint_array(self):
+        return np.asarray(self.checkpoints).reshape(-1, self.sigma)
+
+    def rank_many(self, c, i):
+        """
+        Vectorized rank: occurrences of c[j] in bwt[:i[j]] for every j
+
+        >>> RankTable(b"\\x01\\x02\\x00\\x01\\x01", 3, k=2).rank_many(np.array([1, 1, 2]), np.array([4, 5, 5]))
+        array([2, 3, 1])
+        """
+        bwt = self.bwt_array
+        block = i // self.k
+        start = block * self.k
+        r = self.checkpoint_array[block, c].astype(np.int64)
+        remaining = i - start
+        last = len(bwt) - 1
+        for offset in range(int(remaining.max()) if len(remaining) else 0):
+            position = np.minimum(start + offset, last)
+            r += (offset < remaining) & (bwt[position] == c)
+        return r
+
+def build_checkpoints(bwt, sigma, k):
+    """
+    Counts of each symbol in bwt[:b*k] for every block b, stored row by row.
+
+    >>> list(build_checkpoints(b"\\x01\\x02\\x00\\x01\\x01", 3, 2))
+    [0, 0, 0, 0, 1, 1, 1, 2, 1]
+    """
+    codes = np.frombuffer(bwt, dtype=np.uint8)
+    table = np.zeros((len(codes) // k + 1, sigma), dtype=np.uint32)
+    for c in range(sigma):
+        counts = np.zeros(len(codes) + 1, dtype=np.uint32)
+        np.cumsum(codes == c, dtype=np.uint32, out=counts[1:])
+        table[:, c] = counts[::k]
+    checkpoints = array("I")
+    checkpoints.frombytes(table.tobytes())
+    return checkpoints
+
+# Alphabets with more symbols than this get a WaveletRankTable by default,
+# as the checkpoints of a RankTable grow with the alphabet
+WAVELET_MIN_SIGMA = 16
+# Symbols per 64-bit word of a PackedRankTable
+WORD_SYMBOLS = 32
+# Bit 0 of every 2-bit field of a word
+_LOW_BITS = np.uint64(0x5555555555555555)
+# _PREFIX_MASKS[m]: the fields of the first m symbols of a word
+_PREFIX_MASKS = np.array([(1 << 2 * m) - 1 for m in range(WORD_SYMBOLS + 1)], dtype=np.uint64)
+
+class PackedRankTable:
+    """
+    Rank structure for BWTs that are nearly all made of at most four symbols,
+    such as DNA. Those symbols are stored as 2-bit digits, four to a byte,
+    and the few other ones (the sentinel, record separators, N runs and other
+    IUPAC codes) as a sorted list of runs of exceptions, which take digit 0
+    in the packed array. The checkpoints are the same as in RankTable.
+
+    Between checkpoints a digit is counted by comparing all the 2-bit fields
+    of the packed block at once, so the scan touches a quarter of the bytes.
+    The packed array is padded to whole 64-bit words for the vectorized rank.
+    """
+    KIND = "packed"
+    ARRAYS = ("packed", "checkpoints", "exception_starts", "exception_offsets", "exception_codes")
+
+    def __init__(self, bwt, sigma, k=DEFAULT_SAMPLE_RATE):
+        if k % PACKED_SYMBOLS:
+            raise ValueError(f"the rank sample rate of a packed BWT must be a multiple of {PACKED_SYMBOLS}")
+        codes = np.frombuffer(bytes(bwt), dtype=np.uint8)
+        self.n = len(codes)
+        self.sigma = sigma
+        self.k = k
+        self.checkpoints = build_checkpoints(codes.tobytes(), sigma, k)
+        self.digits = packed_digits(codes, sigma)
+
+        digitOf = np.full(sigma, -1, dtype=np.int64)
+        for c, digit in self.digits.items():
+            digitOf[c] = digit
+        symbolDigits = digitOf[codes]
+        exceptions = np.nonzero(symbolDigits < 0)[0]
+        symbolDigits[exceptions] = 0
+        padded = np.zeros(-(-self.n // WORD_SYMBOLS) * WORD_SYMBOLS, dtype=np.uint8)
+        padded[:self.n] = symbolDigits
+        shifts = np.arange(0, 2 * PACKED_SYMBOLS, 2, dtype=np.uint8)
+        self.packed = (padded.reshape(-1, PACKED_SYMBOLS) << shifts).sum(axis=1, dtype=np.uint8).tobytes()
+
+        # Runs of consecutive exceptions with the same symbol, and the number of exceptions before each run
+        exceptionCodes = codes[exceptions]
+        first = np.ones(len(exceptions), dtype=bool)
+        first[1:] = (np.diff(exceptions) != 1) | (np.diff(exceptionCodes) != 0)
+        runs = np.nonzero(first)[0]
+        typecode = "I" if self.n < 2**32 else "Q"
+        self.exception_starts = array(typecode, exceptions[runs].tolist())
+        self.exception_offsets = array(typecode, runs.tolist() + [len(exceptions)])
+        self.exception_codes = exceptionCodes[runs].tobytes()
+
+    @staticmethod
+    def nbytes_for(codes, sigma, k):
+        """
+        Size of the table of the BWT with the given symbol codes, from the
+        symbol counts and the number of exception runs, without building it
+
+        >>> codes = np.frombuffer(b"\\x01\\x02\\x00\\x03\\x04\\x05\\x05\\x01", dtype=np.uint8)
+        >>> PackedRankTable.nbytes_for(codes, 6, 4) == PackedRankTable(codes, 6, 4).nbytes()
+        True
+        """
+        n = len(codes)
+        exception = np.ones(sigma, dtype=bool)
+        exception[list(packed_digits(codes, sigma))] = False
+        isException = exception[codes]
+        first = isException.copy()
+        first[1:] &= ~isException[:-1] | (codes[1:] != codes[:-1])
+        runs = int(np.count_nonzero(first))
+        itemsize = 4 if n < 2**32 else 8
+        return (-(-n // WORD_SYMBOLS) * WORD_SYMBOLS // PACKED_SYMBOLS + 4 * sigma * (n // k + 1)
+                + itemsize * (2 * runs + 1) + runs)
+
+    @classmethod
+    def from_arrays(cls, arrays, n, sigma, k):
+        """
+        Wraps already built buffers, e.g. views into a memory-mapped index
+        """
+        table = cls.__new__(cls)
+        table.n = n
+        table.sigma = sigma
+        table.k = k
+        for name in cls.ARRAYS:
+            setattr(table, name, arrays[name])
+        table.digits = packed_digits(None, sigma, table.exception_codes)
+        return table
+
+    def arrays(self):
+        typecode = "<u4" if self.exception_starts.itemsize == 4 else "<u8"
+        return {
+            "packed": (_as_array(self.packed), "u1"),
+            "checkpoints": (self.checkpoints, "<u4"),
+            "exception_starts": (self.exception_starts, typecode),
+            "exception_offsets": (self.exception_offsets, typecode),
+            "exception_codes": (_as_array(self.exception_codes), "u1"),
+        }
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        """
+        The symbol at position i of the BWT
+
+        >>> table = PackedRankTable(b"\\x01\\x02\\x00\\x03\\x04\\x05\\x05", 6, k=4)
+        >>> [table[i] for i in range(7)]
+        [1, 2, 0, 3, 4, 5, 5]
+        """
+        j = bisect_right(self.exception_starts, i) - 1
+        if j >= 0 and i < self.exception_starts[j] + self.exception_offsets[j + 1] - self.exception_offsets[j]:
+            return self.exception_codes[j]
+        return self.codes[(self.packed[i >> 2] >> 2 * (i & 3)) & 3]
+
+    @cached_property
+    def codes(self):
+        """
+        Symbol code of every digit
+        """
+        return {digit: c for c, digit in self.digits.items()}
+
+    def rank(self, c, i):
+        """
+        Number of occurrences of the symbol c in bwt[:i]
+
+        >>> table = PackedRankTable(b"\\x01\\x02\\x00\\x03\\x04\\x05\\x05\\x01", 6, k=4)
+        >>> [table.rank(c, 7) for c in range(6)]
+        [1, 1, 1, 1, 1, 2]
+        """
+        block = i // self.k
+        r = self.checkpoints[block * self.sigma + c]
+        start = block * self.k
+        if start == i:
+            return r
+        digit = self.digits.get(c)
+        if digit is None:
+            return r + self._exception_count(c, start, i)
+        # All the 2-bit fields of the block at once: a field is zero after the
+        # xor exactly where it holds the digit
+        bits = 2 * (i - start)
+        mask = (1 << bits) - 1
+        low = mask // 3
+        x = int.from_bytes(self.packed[start >> 2:(i + 3) >> 2], "little") & mask
+        y = x ^ (digit * low)
+        r += i - start - ((y | y >> 1) & low).bit_count()
+        if digit == 0:
+            r -= self._exceptions_before(i) - self._exceptions_before(start)
+        return r
+
+    def _exceptions_before(self, i):
+        j = bisect_right(self.exception_starts, i) - 1
+        if j < 0:
+            return 0
+        length = self.exception_offsets[j + 1] - self.exception_offsets[j]
+        return self.exception_offsets[j] + min(i - self.exception_starts[j], length)
+
+    def _exception_count(self, c, start, end):
+        """
+        Occurrences of the exception symbol c in bwt[start:end]
+        """
+        count = 0
+        j = max(bisect_right(self.exception_starts, start) - 1, 0)
+        while j < len(self.exception_starts) and self.exception_starts[j] < end:
+            if self.exception_codes[j] == c:
+                runEnd = self.exception_starts[j] + self.exception_offsets[j + 1] - self.exception_offsets[j]
+                count += max(min(runEnd, end) - max(self.exception_starts[j], start), 0)
+            j += 1
+        return count
+
+    def nbytes(self):
+        return (len(self.packed) + self.checkpoints.itemsize * len(self.checkpoints)
+                + self.exception_starts.itemsize * (len(self.exception_starts) + len(self.exception_offsets))
+                + len(self.exception_codes))
+
+    @cached_property
+    def checkpoint_array(self):
+        return np.asarray(self.checkpoints).reshape(-1, self.sigma)
+
+    def rank_many(self, c, i):
+        """
+        Vectorized rank: occurrences of c[j] in bwt[:i[j]] for every j
+
+        >>> table = PackedRankTable(b"\\x01\\x02\\x00\\x03\\x04\\x05\\x05\\x01", 6, k=4)
+        >>> table.rank_many(np.array([1, 5, 0, 3]), np.array([8, 7, 3, 6]))
+        array([2, 2, 1, 1])
+        """
+        words = _as_array(self.packed).view("<u8")
+        digitOf = np.full(self.sigma, -1, dtype=np.int64)
+        for symbol, digit in self.digits.items():
+            digitOf[symbol] = digit
+        d = digitOf[c]
+        block = i // self.k
+        start = block * self.k
+        r = self.checkpoint_array[block, c].astype(np.int64)
+        # One word, so up to 32 symbols, per step: the fields of the word
+        # that hold the digit are the ones that are zero after the xor
+        pattern = np.maximum(d, 0).astype(np.uint64) * _LOW_BITS
+        first = start // WORD_SYMBOLS
+        steps = i // WORD_SYMBOLS - first + 1
+        for step in range(int(steps.max()) if len(steps) else 0):
+            base = (first + step) * WORD_SYMBOLS
+            word = np.minimum(first + step, len(words) - 1)
+            mask = (_PREFIX_MASKS[np.clip(i - base, 0, WORD_SYMBOLS)]
+                    & ~_PREFIX_MASKS[np.clip(start - base, 0, WORD_SYMBOLS)])
+            y = words[word] ^ pattern
+            r += np.bitwise_count(~(y | y >> np.uint64(1)) & _LOW_BITS & mask).astype(np.int64)
+
+        starts = _as_array(self.exception_starts).astype(np.int64)
+        offsets = _as_array(self.exception_offsets).astype(np.int64)
+        zero = np.nonzero(d == 0)[0]
+        if len(zero) and len(starts):
+            r[zero] -= _exceptions_before_many(starts, offsets, i[zero]) - _exceptions_before_many(starts, offsets, start[zero])
+        for j in np.nonzero(d < 0)[0].tolist():
+            r[j] = self.rank(int(c[j]), int(i[j]))
+        return r
+
+def _exceptions_before_many(starts, offsets, i):
+    j = np.searchsorted(starts, i, side="right") - 1
+    jj = np.maximum(j, 0)
+    before = offsets[jj] + np.minimum(i - starts[jj], offsets[jj + 1] - offsets[jj])
+    return np.where(j >= 0, before, 0)
+
+def _as_array(values):
+    if isinstance(values, (bytes, bytearray)):
+        return np.frombuffer(values, dtype=np.uint8)
+    return np.asarray(values)
+
+def packed_digits(codes, sigma, exceptionCodes=None):
+    """
+    Picks the (at most four) symbols of a BWT that are stored as 2-bit
+    digits: the most frequent ones, ties broken by code, numbered in code
+    order. Given the exception codes of a built table instead of the BWT,
+    recovers the same choice: the symbols that are not exceptions.
+
+    >>> packed_digits(np.frombuffer(b"\\x01\\x02\\x00\\x03\\x04\\x05\\x05\\x01", dtype=np.uint8), 6)
+    {0: 0, 1: 1, 2: 2, 5: 3}
+    """
+    if codes is None:
+        excluded = set(exceptionCodes[:len(exceptionCodes)])
+        symbols = [c for c in range(sigma) if c not in excluded][:PACKED_SYMBOLS]
+    else:
+        counts = np.bincount(codes, minlength=sigma)
+        symbols = sorted(sorted(range(sigma), key=lambda c: -counts[c])[:PACKED_SYMBOLS])
+    return {c: digit for digit, c in enumerate(symbols)}
+
+class WaveletRankTable:
+    """
+    Rank structure for large alphabets (protein, generic text): a wavelet
+    matrix over the BWT. Level l holds bit l (from the most significant one)
+    of every symbol as a BitVector, with the symbols stably sorted by their
+    higher bits, so rank and access take one bit vector rank per level:
+    O(log sigma) time and about 2 n log sigma bits, whatever the alphabet.
+    """
+    KIND = "wavelet"
+    ARRAYS = ("level_words", "level_ranks", "zeros")
+
+    def __init__(self, bwt, sigma, k=DEFAULT_SAMPLE_RATE):
+        codes = np.frombuffer(bytes(bwt), dtype=np.uint8)
+        self.n = len(codes)
+        self.sigma = sigma
+        # Not used, kept so every rank table has the sample rate it was asked for
+        self.k = k
+        words, ranks = array("Q"), array("Q")
+        zeros = []
+        for shift in range(max(sigma - 1, 1).bit_length() - 1, -1, -1):
+            bits = (codes >> shift) & 1
+            level = BitVector(bits)
+            words.extend(level.words)
+            ranks.extend(level.ranks)
+            zeros.append(self.n - level.rank1(self.n))
+            codes = np.concatenate((codes[bits == 0], codes[bits == 1]))
+        self.level_words = words
+        self.level_ranks = ranks
+        self.zeros = array("Q", zeros)
+        self._levels()
+
+    @classmethod
+    def from_arrays(cls, arrays, n, sigma, k):
+        """
+        Wraps already built buffers, e.g. views into a memory-mapped index
+        """
+        table = cls.__new__(cls)
+        table.n = n
+        table.sigma = sigma
+        table.k = k
+        for name in cls.ARRAYS:
+            setattr(table, name, arrays[name])
+        table._levels()
+        return table
+
+    def _levels(self):
+        nWords = (self.n + 63) // 64
+        self.levels = [BitVector.from_buffers(self.n, self.level_words[l * nWords:(l + 1) * nWords],
+                                              self.level_ranks[l * (nWords + 1):(l + 1) * (nWords + 1)])
+                       for l in range(len(self.zeros))]
+
+    def arrays(self):
+        return {
+            "level_words": (self.level_words, "<u8"),
+            "level_ranks": (self.level_ranks, "<u8"),
+            "zeros": (self.zeros, "<u8"),
+        }
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        """
+        The symbol at position i of the BWT
+
+        >>> table = WaveletRankTable(b"\\x03\\x01\\x00\\x04\\x02\\x01", 5)
+        >>> [table[i] for i in range(6)]
+        [3, 1, 0, 4, 2, 1]
+        """
+        c = 0
+        for level, zeros in zip(self.levels, self.zeros):
+            bit = level[i]
+            c = c << 1 | bit
+            i = zeros + level.rank1(i) if bit else i - level.rank1(i)
+        return c
+
+    def rank(self, c, i):
+        """
+        Number of occurrences of the symbol c in bwt[:i]
+
+        >>> table = WaveletRankTable(b"\\x03\\x01\\x00\\x04\\x02\\x01", 5)
+        >>> [table.rank(c, 6) for c in range(5)], table.rank(1, 2)
+        ([1, 2, 1, 1, 1], 1)
+        """
+        # Follow both ends of bwt[:i] down to the range of the symbols equal to c
+        start = 0
+        shift = len(self.levels)
+        for level, zeros in zip(self.levels, self.zeros):
+            shift -= 1
+            if (c >> shift) & 1:
+                start = zeros + level.rank1(start)
+                i = zeros + level.rank1(i)
+            else:
+                start -= level.rank1(start)
+                i -= level.rank1(i)
+        return i - start
+
+    def rank_many(self, c, i):
+        """
+        Vectorized rank: occurrences of c[j] in bwt[:i[j]] for every j
+
+        >>> WaveletRankTable(b"\\x03\\x01\\x00\\x04\\x02\\x01", 5).rank_many(np.array([1, 1, 4]), np.array([6, 2, 3]))
+        array([2, 1, 0])
+        """
+        c = np.asarray(c, dtype=np.int64)
+        start = np.zeros(len(c), dtype=np.int64)
+        i = np.asarray(i, dtype=np.int64)
+        shift = len(self.levels)
+        for level, zeros in zip(self.levels, self.zeros):
+            shift -= 1
+            bit = ((c >> shift) & 1).astype(bool)
+            startOnes = level.rank1_many(start)
+            endOnes = level.rank1_many(i)
+            start = np.where(bit, zeros + startOnes, start - startOnes)
+            i = np.where(bit, zeros + endOnes, i - endOnes)
+        return i - start
+
+    def nbytes(self):
+        return 8 * (len(self.level_words) + len(self.level_ranks) + len(self.zeros))
+
+class RunLengthRankTable:
+    """
+    Rank structure for highly repetitive texts, in O(r) space for a BWT of
+    r runs: the start and symbol of every run, plus the runs sorted by
+    (symbol, run) with the total length of the runs before each of them.
+    The rank of c at i is the length of the runs of c before the run of i,
+    found by binary search among the runs of c, plus the part of the run of
+    i before i if its symbol is c.
+    """
+    KIND = "runs"
+    ARRAYS = ("run_starts", "run_symbols", "symbol_keys", "symbol_counts")
+
+    def __init__(self, bwt, sigma, k=DEFAULT_SAMPLE_RATE):
+        codes = np.frombuffer(bytes(bwt), dtype=np.uint8)
+        self.n = len(codes)
+        self.sigma = sigma
+        # Not used, kept so every rank table has the sample rate it was asked for
+        self.k = k
+        starts = np.flatnonzero(np.diff(codes, prepend=-1) != 0) if self.n else np.zeros(0, dtype=np.int64)
+        symbols = codes[starts]
+        lengths = np.diff(np.append(starts, self.n))
+        r = len(starts)
+        order = np.lexsort((np.arange(r), symbols))
+        self.run_starts = array("Q", np.append(starts, self.n).tolist())
+        self.run_symbols = symbols.tobytes()
+        self.symbol_keys = array("Q", (symbols[order].astype(np.int64) * r + order).tolist())
+        self.symbol_counts = array("Q", np.concatenate(([0], np.cumsum(lengths[order]))).tolist())
+        self._symbol_firsts()
+
+    @classmethod
+    def from_arrays(cls, arrays, n, sigma, k):
+        """
+        Wraps already built buffers, e.g. views into a memory-mapped index
+        """
+        table = cls.__new__(cls)
+        table.n = n
+        table.sigma = sigma
+        table.k = k
+        for name in cls.ARRAYS:
+            setattr(table, name, arrays[name])
+        table._symbol_firsts()
+        return table
+
+    def _symbol_firsts(self):
+        # Index in symbol_keys of the first run of every symbol, and the occurrences of the smaller symbols
+        self.runs = len(self.run_symbols)
+        self.firsts = [bisect_left(self.symbol_keys, c * self.runs) for c in range(self.sigma + 1)]
+        self.smaller = [self.symbol_counts[j] for j in self.firsts]
+
+    def arrays(self):
+        return {
+            "run_starts": (self.run_starts, "<u8"),
+            "run_symbols": (self.run_symbols_array(), "u1"),
+            "symbol_keys": (self.symbol_keys, "<u8"),
+            "symbol_counts": (self.symbol_counts, "<u8"),
+        }
+
+    def __len__(self):
+        return self.n
+
+    def run_of(self, i):
+        """
+        Index of the run that contains position i of the BWT
+        """
+        return min(bisect_right(self.run_starts, i) - 1, self.runs - 1)
+
+    def last_run(self, c, k):
+        """
+        Index of the last run of the symbol c before run k, or None
+        """
+        j = bisect_left(self.symbol_keys, c * self.runs + k, self.firsts[c], self.firsts[c + 1]) - 1
+        if j < self.firsts[c]:
+            return None
+        return self.symbol_keys[j] - c * self.runs
+
+    def run_symbols_array(self):
+        return _as_array(self.run_symbols)
+
+    def run_of_many(self, i):
+        starts = np.asarray(self.run_starts, dtype=np.int64)
+        return np.minimum(np.searchsorted(starts, i, side="right") - 1, self.runs - 1)
+
+    def last_run_many(self, c, k):
+        """
+        Vectorized last_run, with -1 where c has no run before k
+        """
+        keys = np.asarray(self.symbol_keys, dtype=np.int64)
+        j = np.searchsorted(keys, c * self.runs + k) - 1
+        found = j >= np.asarray(self.firsts, dtype=np.int64)[c]
+        return np.where(found, keys[np.maximum(j, 0)] - c * self.runs, -1)
+
+    def __getitem__(self, i):
+        """
+        The symbol at position i of the BWT
+
+        >>> table = RunLengthRankTable(b"\\x02\\x02\\x01\\x00\\x02\\x02\\x01", 3)
+        >>> [table[i] for i in range(7)], table.runs
+        ([2, 2, 1, 0, 2, 2, 1], 5)
+        """
+        return self.run_symbols[self.run_of(i)]
+
+    def rank(self, c, i):
+        """
+        Number of occurrences of the symbol c in bwt[:i]
+
+        >>> table = RunLengthRankTable(b"\\x02\\x02\\x01\\x00\\x02\\x02\\x01", 3)
+        >>> [table.rank(c, 7) for c in range(3)], table.rank(2, 5), table.rank(1, 0)
+        ([1, 2, 4], 3, 0)
+        """
+        k = self.run_of(i)
+        j = bisect_left(self.symbol_keys, c * self.runs + k, self.firsts[c], self.firsts[c + 1])
+        count = self.symbol_counts[j] - self.smaller[c]
+        if self.run_symbols[k] == c:
+            count += i - self.run_starts[k]
+        return count
+
+    def rank_many(self, c, i):
+        """
+        Vectorized rank: occurrences of c[j] in bwt[:i[j]] for every j
+
+        >>> table = RunLengthRankTable(b"\\x02\\x02\\x01\\x00\\x02\\x02\\x01", 3)
+        >>> table.rank_many(np.array([2, 2, 1, 0]), np.array([5, 7, 0, 4]))
+        array([3, 4, 0, 1])
+        """
+        c = np.asarray(c, dtype=np.int64)
+        i = np.asarray(i, dtype=np.int64)
+        starts = np.asarray(self.run_starts, dtype=np.int64)
+        k = self.run_of_many(i)
+        j = np.searchsorted(np.asarray(self.symbol_keys, dtype=np.int64), c * self.runs + k)
+        counts = np.asarray(self.symbol_counts, dtype=np.int64)
+        inRun = np.where(self.run_symbols_array()[k] == c, i - starts[k], 0)
+        return counts[j] - np.asarray(self.smaller, dtype=np.int64)[c] + inRun
+
+    def nbytes(self):
+        return 8 * (len(self.run_starts) + len(self.symbol_keys) + len(self.symbol_counts)) + len(self.run_symbols)
+
+RANK_TABLES = {table.KIND: table for table in (RankTable, PackedRankTable, WaveletRankTable, RunLengthRankTable)}
+
+def rank_table_for(bwt, sigma, k=DEFAULT_SAMPLE_RATE, backend="auto"):
+    """
+    Builds the rank structure of the BWT with the given backend. With "auto"
+    the BWT is packed when its estimated size is below that of one byte per
+    symbol, which is the case for DNA, alphabets larger than WAVELET_MIN_SIGMA
+    get a wavelet matrix, and the rest a plain table.
+
+    >>> rank_table_for(b"\\x01\\x02\\x03\\x04" * 8 + b"\\x00", 5).KIND
+    'packed'
+    >>> rank_table_for(bytes(range(1, 9)) * 4 + b"\\x00", 9).KIND
+    'plain'
+    >>> rank_table_for(bytes(range(1, 21)) * 4 + b"\\x00", 21).KIND
+    'wavelet'
+    """
+    if backend == "auto":
+        backend = WaveletRankTable.KIND if sigma > WAVELET_MIN_SIGMA else RankTable.KIND
+        # Only the size of the packed table is worked out first, and not even
+        # that for alphabets large enough for the wavelet matrix
+        if k % PACKED_SYMBOLS == 0 and sigma <= WAVELET_MIN_SIGMA:
+            codes = np.frombuffer(bytes(bwt), dtype=np.uint8)
+            if PackedRankTable.nbytes_for(codes, sigma, k) < RankTable.nbytes_for(len(codes), sigma, k):
+                return PackedRankTable(codes, sigma, k)
+    return RANK_TABLES[backend](bwt, sigma, k)
+
+class BitVector:
+    """
+    Plain bit vector with constant time rank, stored as 64-bit words plus
+    the number of set bits before every word.
+    """
+    def __init__(self, bits):
+        bits = np.asarray(bits, dtype=bool)
+        self.n = len(bits)
+        padded = np.zeros((self.n + 63) // 64 * 64, dtype=bool)
+        padded[:self.n] = bits
+        words = np.packbits(padded, bitorder="little").view("<u8")
+        ranks = np.zeros(len(words) + 1, dtype=np.uint64)
+        np.cumsum(padded.reshape(-1, 64).sum(axis=1), out=ranks[1:])
+        self.words = array("Q")
+        self.words.frombytes(words.tobytes())
+        self.ranks = array("Q")
+        self.ranks.frombytes(ranks.tobytes())
+
+    @classmethod
+    def from_buffers(cls, n, words, ranks):
+        vector = cls.__new__(cls)
+        vector.n = n
+        vector.words = words
+        vector.ranks = ranks
+        return vector
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return (self.words[i >> 6] >> (i & 63)) & 1
+
+    def rank1(self, i):
+        """
+        Number of set bits in bits[:i]
+
+        >>> BitVector([1, 0, 1, 1, 0]).rank1(4)
+        3
+        """
+        r = self.ranks[i >> 6]
+        if i & 63:
+            r += (self.words[i >> 6] & ((1 << (i & 63)) - 1)).bit_count()
+        return r
+
+    def rank1_many(self, i):
+        """
+        Vectorized rank1
+
+        >>> BitVector([1, 0, 1, 1, 0] * 20).rank1_many(np.array([4, 64, 100]))
+        array([ 3, 39, 60])
+        """
+        words = np.asarray(self.words, dtype=np.uint64)
+        word = i >> 6
+        before = np.asarray(self.ranks, dtype=np.int64)[word]
+        # i can be n, one word past the end when n is a multiple of 64, but then nothing is masked in
+        masks = (np.uint64(1) << (i & 63).astype(np.uint64)) - np.uint64(1)
+        inWord = words[np.minimum(word, max(len(words) - 1, 0))] & masks if len(words) else 0
+        return before + np.bitwise_count(inWord).astype(np.int64)
+
+    def nbytes(self):
+        return 8 * (len(self.words) + len(self.ranks))
@@ -0,0 +1,184 @@
+"""
+Opening of genome and read files, which may be compressed.
+
+The format is detected from the first bytes of the file, whatever its
+name: plain text, gzip, BGZF (the blocked gzip of htslib, which any gzip
+reader also reads) or bzip2. BGZF files are made of independent blocks of
+at most 64 kB, so they are decompressed in parallel: a thread reads the
+blocks in order and hands them to a pool of threads (zlib releases the
+GIL while inflating), and the parser takes the results from a bounded
+queue, in order, so at most a few blocks per thread are held ahead of it.
+"""
+import bz2
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+READ_BUFFER_SIZE = 1 << 20
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+# Blocks decompressed or being decompressed ahead of the parser, per thread
+PENDING_PER_THREAD = 4
+GZIP_MAGIC = b"\x1f\x8b\x08"
+BZIP2_MAGIC = b"BZh"
+# Gzip header flag telling that an extra field follows the fixed header
+FEXTRA = 4
+# Length of the fixed part of a gzip member header, up to the length of its extra field
+GZIP_HEADER = 12
+
+def detect(head):
+    """
+    The format of a file starting with the bytes head: "plain", "gzip",
+    "bgzf" or "bz2"
+
+    >>> detect(b"@read1"), detect(b"BZh91AY&SY"), detect(gzip.compress(b"x")[:18])
+    ('plain', 'bz2', 'gzip')
+    >>> detect(bgzf_block(b"@read1\\nacgt\\n")[:18])
+    'bgzf'
+    """
+    if head.startswith(BZIP2_MAGIC):
+        return "bz2"
+    if head.startswith(GZIP_MAGIC):
+        if len(head) >= 16 and head[3] & FEXTRA and head[12:14] == b"BC":
+            return "bgzf"
+        return "gzip"
+    return "plain"
+
+def open_text(filename, threads=DEFAULT_THREADS):
+    """
+    Opens filename for reading as text, decompressing it if needed, BGZF
+    with the given number of threads
+    """
+    with open(filename, "rb") as file:
+        kind = detect(file.read(18))
+    if kind == "plain":
+        return open(filename, buffering=READ_BUFFER_SIZE)
+    if kind == "bz2":
+        return io.TextIOWrapper(_NamedBZ2File(filename))
+    if kind == "gzip" or threads <= 1:
+        return io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(filename), READ_BUFFER_SIZE))
+    return io.TextIOWrapper(io.BufferedReader(BGZFReader(filename, threads), READ_BUFFER_SIZE))
+
+class _NamedBZ2File(bz2.BZ2File):
+    # BZ2File has no name, which the text wrapper reports as its own
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.name = filename
+
+def bgzf_block(data):
+    """
+    One BGZF block holding data, which must be at most 64 kB; b"" gives the
+    empty block that ends a BGZF file
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    extra = struct.pack("<2sHH", b"BC", 2, GZIP_HEADER + 6 + len(payload) + 8 - 1)
+    header = GZIP_MAGIC + bytes([FEXTRA]) + b"\0\0\0\0\0\xff" + struct.pack("<H", len(extra))
+    return header + extra + payload + struct.pack("<II", zlib.crc32(data), len(data))
+
+def read_block(file):
+    """
+    The deflated data, CRC and size of the next block of a BGZF file, or
+    None at its end
+    """
+    header = file.read(GZIP_HEADER)
+    if not header:
+        return None
+    if len(header) < GZIP_HEADER or not header.startswith(GZIP_MAGIC) or not header[3] & FEXTRA:
+        raise ValueError(f"{file.name} is not a valid BGZF file")
+    extra = file.read(struct.unpack_from("<H", header, 10)[0])
+    blockSize = None
+    position = 0
+    while position + 4 <= len(extra):
+        tag, length = struct.unpack_from("<2sH", extra, position)
+        if tag == b"BC" and length == 2:
+            blockSize = struct.unpack_from("<H", extra, position + 4)[0] + 1
+        position += 4 + length
+    if blockSize is None:
+        raise ValueError(f"{file.name} has a gzip member without a BGZF block size")
+    rest = file.read(blockSize - GZIP_HEADER - len(extra))
+    if len(rest) != blockSize - GZIP_HEADER - len(extra):
+        raise ValueError(f"{file.name} ends in the middle of a BGZF block")
+    crc, size = struct.unpack_from("<II", rest, len(rest) - 8)
+    return rest[:-8], crc, size
+
+def inflate_block(block):
+    """
+    The data of a block returned by read_block, checked against its CRC and size
+    """
+    deflated, crc, size = block
+    data = zlib.decompress(deflated, -15)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise ValueError("corrupted BGZF block")
+    return data
+
+class BGZFReader(io.RawIOBase):
+    """
+    Raw binary stream of the decompressed contents of a BGZF file, inflated
+    by a pool of threads and read in order from a bounded queue
+    """
+    def __init__(self, filename, threads=DEFAULT_THREADS):
+        self.name = filename
+        self.file = open(filename, "rb")
+        self.pool = ThreadPoolExecutor(threads)
+        # Futures of the inflated blocks in file order, then an exception or None at the end
+        self.pending = queue.Queue(PENDING_PER_THREAD * threads)
+        self.closing = threading.Event()
+        self.data = b""
+        self.offset = 0
+        self.done = False
+        self.reader = threading.Thread(target=self._read_blocks, daemon=True)
+        self.reader.start()
+
+    def _read_blocks(self):
+        end = None
+        try:
+            while not self.closing.is_set():
+                block = read_block(self.file)
+                if block is None:
+                    break
+                self._put(self.pool.submit(inflate_block, block))
+        except Exception as e:
+            end = e
+        self._put(end)
+
+    def _put(self, item):
+        while not self.closing.is_set():
+            try:
+                self.pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.data):
+            if self.done:
+                return 0
+            item = self.pending.get()
+            if item is None:
+                self.done = True
+                return 0
+            if isinstance(item, Exception):
+                self.done = True
+                raise item
+            self.data = item.result()
+            self.offset = 0
+        n = min(len(buffer), len(self.data) - self.offset)
+        buffer[:n] = self.data[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.closing.set()
+            self.reader.join()
+            self.pool.shutdown(cancel_futures=True)
+            self.file.close()
+        super().close()
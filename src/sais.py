@@ -0,0 +1,143 @@
+def encode_text(x):
+    """
+    Maps the bytes of x to small integers that keep the alphabetical order.
+    The last symbol of x is taken to be the sentinel and gets code 0, every
+    other symbol gets 1 + its rank among the distinct symbols of x[:-1].
+    Returns the encoded text and the size of the resulting alphabet.
+
+    >>> encode_text(b"mississippi$")
+    ([2, 1, 4, 4, 1, 4, 4, 1, 3, 3, 1, 0], 5)
+    >>> encode_text(b"$")
+    ([0], 1)
+    """
+    symbols = sorted(set(x[:-1]))
+    codes = {s: i + 1 for i, s in enumerate(symbols)}
+    encoded = [codes[s] for s in x[:-1]]
+    encoded.append(0)
+    return encoded, len(symbols) + 1
+
+
+def sais(x, sigma):
+    """
+    Builds the suffix array of x in O(n) using induced sorting (SA-IS).
+    x must be a sequence of integers in range(sigma) that ends with a
+    unique sentinel 0.
+
+    >>> sais([2, 1, 4, 4, 1, 4, 4, 1, 3, 3, 1, 0], 5)
+    [11, 10, 7, 4, 1, 0, 9, 8, 6, 3, 5, 2]
+    >>> sais([0], 1)
+    [0]
+    """
+    n = len(x)
+    if n == 1:
+        return [0]
+
+    # S-type suffixes are smaller than the suffix to their right
+    stype = bytearray(n)
+    stype[n - 1] = 1
+    for i in range(n - 2, -1, -1):
+        if x[i] < x[i + 1] or (x[i] == x[i + 1] and stype[i + 1]):
+            stype[i] = 1
+
+    lms = bytearray(n)
+    for i in range(1, n):
+        if stype[i] and not stype[i - 1]:
+            lms[i] = 1
+    lmsPositions = [i for i in range(n) if lms[i]]
+
+    counts = [0] * sigma
+    for c in x:
+        counts[c] += 1
+
+    sa = _induce(x, sigma, counts, stype, lmsPositions)
+
+    # Name the LMS substrings in the order they were induced
+    names = [-1] * n
+    name = 0
+    prev = -1
+    for i in sa:
+        if not lms[i]:
+            continue
+        if prev >= 0 and not _lms_equal(x, stype, lms, prev, i):
+            name += 1
+        names[i] = name
+        prev = i
+    reduced = [names[i] for i in lmsPositions]
+
+    if name + 1 == len(reduced):
+        # Every LMS substring is unique, so the order is given by the names
+        reducedSA = [0] * len(reduced)
+        for i, r in enumerate(reduced):
+            reducedSA[r] = i
+    else:
+        reducedSA = sais(reduced, name + 1)
+
+    return _induce(x, sigma, counts, stype, [lmsPositions[i] for i in reducedSA])
+
+
+def _bucket_heads(counts):
+    heads = [0] * len(counts)
+    total = 0
+    for c, count in enumerate(counts):
+        heads[c] = total
+        total += count
+    return heads
+
+
+def _bucket_tails(counts):
+    tails = [0] * len(counts)
+    total = 0
+    for c, count in enumerate(counts):
+        total += count
+        tails[c] = total
+    return tails
+
+
+def _induce(x, sigma, counts, stype, lmsOrder):
+    """
+    Places the LMS suffixes at the end of their buckets in the given order
+    and induces the positions of the L-type and S-type suffixes from them.
+    """
+    n = len(x)
+    sa = [-1] * n
+
+    tails = _bucket_tails(counts)
+    for i in reversed(lmsOrder):
+        c = x[i]
+        tails[c] -= 1
+        sa[tails[c]] = i
+
+    heads = _bucket_heads(counts)
+    for j in range(n):
+        i = sa[j] - 1
+        if i >= 0 and not stype[i]:
+            c = x[i]
+            sa[heads[c]] = i
+            heads[c] += 1
+
+    tails = _bucket_tails(counts)
+    for j in range(n - 1, -1, -1):
+        i = sa[j] - 1
+        if i >= 0 and stype[i]:
+            c = x[i]
+            tails[c] -= 1
+            sa[tails[c]] = i
+
+    return sa
+
+
+def _lms_equal(x, stype, lms, a, b):
+    """
+    Checks if the LMS substrings starting at a and b are identical.
+    """
+    n = len(x)
+    if a == n - 1 or b == n - 1:
+        # The sentinel is unique
+        return False
+    k = 0
+    while True:
+        if k > 0 and lms[a + k] and lms[b + k]:
+            return True
+        if lms[a + k] != lms[b + k] or x[a + k] != x[b + k] or stype[a + k] != stype[b + k]:
+            return False
+        k += 1
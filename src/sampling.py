@@ -0,0 +1,172 @@
+from array import array
+from bisect import bisect_right
+import numpy as np
+import rank
+
+# Text positions between two samples of the inverse suffix array
+DEFAULT_ISA_SAMPLE = 32
+# Suffix array values handled at a time when sampling the inverse suffix array
+ISA_BLOCK = 1 << 20
+
+def sample_array(values, n):
+    """
+    Stores values in the smallest unsigned array type that fits positions up to n
+    """
+    return array("I" if n < 2**32 else "Q", values)
+
+class SampledSuffixArray:
+    """
+    Suffix array where only some of the values are kept.
+
+    With mode "text" the values that are multiples of s are kept, so at most
+    s-1 LF steps are needed to reach a sample. With mode "row" every s-th row
+    is kept, which needs no bit vector but gives no bound on the walk.
+    """
+    def __init__(self, f, s=1, mode="text"):
+        self.n = len(f)
+        self.s = s
+        self.mode = mode if s > 1 else "row"
+        self.marks = None
+        if self.mode == "row":
+            self.samples = sample_array(np.asarray(f)[::s].tolist(), self.n)
+        elif self.mode == "text":
+            f = np.asarray(f)
+            marked = f % s == 0
+            self.marks = rank.BitVector(marked)
+            self.samples = sample_array(f[marked].tolist(), self.n)
+        else:
+            raise ValueError(f"unknown suffix array sampling mode: {mode}")
+
+    @classmethod
+    def from_buffers(cls, n, s, mode, samples, marks=None):
+        sa = cls.__new__(cls)
+        sa.n = n
+        sa.s = s
+        sa.mode = mode
+        sa.samples = samples
+        sa.marks = marks
+        return sa
+
+    def __len__(self):
+        return self.n
+
+    def lookup(self, row):
+        """
+        The suffix array value at row, or None if it was not sampled
+        """
+        if self.mode == "row":
+            if row % self.s == 0:
+                return self.samples[row // self.s]
+            return None
+        if self.marks[row]:
+            return self.samples[self.marks.rank1(row)]
+        return None
+
+    def nbytes(self):
+        size = self.samples.itemsize * len(self.samples)
+        if self.marks is not None:
+            size += self.marks.nbytes()
+        return size
+
+class RunSampledSuffixArray:
+    """
+    Suffix array of an r-index, sampled at the boundaries of the BWT runs of
+    a RunLengthRankTable: the value at the last row of every run (samples),
+    and the value at the first row of every run but the first (heads),
+    sorted, with the value at the row before it (previous). Given the value
+    at one row, phi gives the value at the row before it from the closest
+    head before it in the text, so a whole interval is located from the
+    value at its last row (its toehold). Every other row is only found by
+    walking LF to the end of a run, with no bound on the walk.
+    """
+    mode = "runs"
+    s = 1
+    marks = None
+
+    def __init__(self, f, runs):
+        self.n = len(f)
+        self.runs = runs
+        starts = np.asarray(runs.run_starts, dtype=np.int64)
+        f = np.asarray(f)
+        self.samples = sample_array(f[starts[1:] - 1].tolist(), self.n)
+        heads = f[starts[1:-1]]
+        order = np.argsort(heads, kind="stable")
+        self.heads = sample_array(heads[order].tolist(), self.n)
+        self.previous = sample_array(f[starts[1:-1] - 1][order].tolist(), self.n)
+
+    @classmethod
+    def from_buffers(cls, n, runs, samples, heads, previous):
+        sa = cls.__new__(cls)
+        sa.n = n
+        sa.runs = runs
+        sa.samples = samples
+        sa.heads = heads
+        sa.previous = previous
+        return sa
+
+    def __len__(self):
+        return self.n
+
+    def lookup(self, row):
+        """
+        The suffix array value at row, or None if row does not end a run
+        """
+        k = self.runs.run_of(row)
+        if row == self.runs.run_starts[k + 1] - 1:
+            return self.samples[k]
+        return None
+
+    def phi(self, value):
+        """
+        The suffix array value at the row before the row of value
+        """
+        j = bisect_right(self.heads, value) - 1
+        return self.previous[j] + value - self.heads[j]
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.samples, self.heads, self.previous))
+
+class SampledInverseSuffixArray:
+    """
+    Inverse suffix array sampled at the text positions that are multiples of
+    s: the row of the suffix starting at every such position. Any substring
+    of the text is rebuilt from the BWT by LF-mapping back from the first
+    sampled position at or after its end, walking over at most s-1 letters
+    more than asked for.
+
+    >>> isa = SampledInverseSuffixArray([11, 10, 7, 4, 1, 0, 9, 8, 6, 3, 5, 2], 4)
+    >>> list(isa.samples), isa.anchor(5), isa.anchor(9)
+    ([5, 3, 7], (8, 7), (11, 0))
+    """
+    def __init__(self, f, s=DEFAULT_ISA_SAMPLE):
+        self.n = len(f)
+        self.s = s
+        samples = np.zeros(-(-self.n // s), dtype=np.uint32 if self.n < 2**32 else np.uint64)
+        # Read a block at a time, as f may be a suffix array spilled to disk
+        for start in range(0, self.n, ISA_BLOCK):
+            block = np.asarray(f[start:start + ISA_BLOCK])
+            rows = np.flatnonzero(block % s == 0)
+            samples[block[rows] // s] = rows + start
+        self.samples = sample_array(samples.tolist(), self.n)
+
+    @classmethod
+    def from_buffers(cls, n, s, samples):
+        isa = cls.__new__(cls)
+        isa.n = n
+        isa.s = s
+        isa.samples = samples
+        return isa
+
+    def anchor(self, position):
+        """
+        (sampled position, row of its suffix) for the first sampled position
+        at or after position, or the sentinel at the end of the text (whose
+        suffix is always row 0) if there is none
+        """
+        sampled = -(-position // self.s) * self.s
+        if sampled >= self.n - 1:
+            return self.n - 1, 0
+        return sampled, self.samples[sampled // self.s]
+
+    def nbytes(self):
+        return self.samples.itemsize * len(self.samples)
@@ -0,0 +1,142 @@
+"""
+Seeds of a read: exact matches between pieces of the read and the genome,
+found from the FM-index intervals, so that an aligner only has to look at
+the windows of the genome around their occurrences.
+
+Super-maximal exact matches (SMEMs) are found with the bidirectional
+index as in BWA-MEM: from a start x, the match is extended to the right as
+far as it goes, keeping the intervals where it loses occurrences, and all
+of those are then extended to the left together. Fixed-length seeds only
+need backward search, and the seeds of a whole block are searched at once.
+"""
+import batch
+import bidirectional
+
+DEFAULT_SEED_LENGTH = 19
+DEFAULT_MAX_OCCURRENCES = 500
+
+class Seeding:
+    """
+    How reads are seeded: super-maximal exact matches of at least length
+    letters (smem), or the non-overlapping pieces of length letters
+    (fixed). Only seeds with at most maxOccurrences occurrences are located.
+    """
+    MODES = ["smem", "fixed"]
+
+    def __init__(self, mode="smem", length=DEFAULT_SEED_LENGTH, maxOccurrences=DEFAULT_MAX_OCCURRENCES):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown seeding mode {mode!r}")
+        if length < 1:
+            raise ValueError(f"the seed length must be at least 1, not {length}")
+        if maxOccurrences < 0:
+            raise ValueError(f"the maximum number of occurrences of a seed can't be negative, not {maxOccurrences}")
+        self.mode = mode
+        self.length = length
+        self.maxOccurrences = maxOccurrences
+
+    def search(self, bwtMatcher, sequences):
+        """
+        The seeds of every sequence, as lists of (start, end, interval)
+        """
+        if self.mode == "fixed":
+            return fixed_seeds(bwtMatcher, sequences, self.length)
+        return [smems(bwtMatcher, p, self.length) for p in sequences]
+
+def seed_cigar(start, end, length):
+    """
+    CIGAR of a seed covering read[start:end], with the rest of the read soft clipped
+
+    >>> seed_cigar(0, 5, 5), seed_cigar(2, 5, 9)
+    ('5M', '2S3M4S')
+    """
+    cigar = f"{end - start}M"
+    if start > 0:
+        cigar = f"{start}S{cigar}"
+    if end < length:
+        cigar = f"{cigar}{length - end}S"
+    return cigar
+
+def smems(bwtMatcher, p, minLength=1):
+    """
+    (start, end, (left, right)) for every super-maximal exact match
+    p[start:end] of at least minLength letters, sorted by start: a match
+    that can not be extended on either side and is not part of a longer
+    one. (left, right) is its suffix array interval. Needs a reverse index.
+    """
+    bidirectional.require_reverse_index(bwtMatcher)
+    codes = _codes(bwtMatcher, p)
+    found = []
+    x = 0
+    while x < len(codes):
+        if codes[x] is None:
+            x += 1
+        else:
+            x = _smems_from(bwtMatcher, codes, x, found)
+    found.sort()
+    return [(start, end, (interval[0], interval[0] + interval[2]))
+            for start, end, interval in found if end - start >= minLength]
+
+def _smems_from(bwtMatcher, codes, x, found):
+    """
+    Adds the SMEMs that contain codes[x] to found, and returns the end of
+    the longest match starting at x, where the next search starts
+    """
+    interval = bidirectional.extend_left(bwtMatcher, bidirectional.full_interval(bwtMatcher), codes[x])
+    # (end, interval) of the matches starting at x that have fewer occurrences once extended to the right
+    extensions = []
+    end = x + 1
+    while True:
+        c = codes[end] if end < len(codes) else None
+        extended = None if c is None else bidirectional.extend_right(bwtMatcher, interval, c)
+        if extended is None or extended[2] != interval[2]:
+            extensions.append((end, interval))
+        if extended is None or extended[2] == 0:
+            break
+        interval = extended
+        end += 1
+    nextStart = extensions[-1][0]
+
+    # Longest first, so the first one that can not be extended to the left is an SMEM
+    extensions.reverse()
+    lastStart = None
+    for i in range(x - 1, -2, -1):
+        c = codes[i] if i >= 0 else None
+        kept = []
+        for end, interval in extensions:
+            extended = None if c is None else bidirectional.extend_left(bwtMatcher, interval, c)
+            if extended is None or extended[2] == 0:
+                if not kept and (lastStart is None or i + 1 < lastStart):
+                    found.append((i + 1, end, interval))
+                    lastStart = i + 1
+            elif not kept or extended[2] != kept[-1][1][2]:
+                kept.append((end, extended))
+        if not kept:
+            break
+        extensions = kept
+    return nextStart
+
+def _codes(bwtMatcher, p):
+    # None for the letters that are not in the genome, or the sentinel
+    alphadic = bwtMatcher.alphadic
+    return [c if c else None for c in map(alphadic.get, p)]
+
+def fixed_seeds(bwtMatcher, sequences, length):
+    """
+    (start, end, interval) of the pieces sequence[start:start + length],
+    for start a multiple of length, that occur in the genome, for every
+    sequence, with the interval as given by batch.search_intervals. All the
+    pieces are searched in one batch.
+    """
+    pieces = []
+    owners = []
+    for j, p in enumerate(sequences):
+        for start in range(0, len(p) - length + 1, length):
+            pieces.append(p[start:start + length])
+            owners.append((j, start))
+    seeds = [[] for _ in sequences]
+    if not pieces:
+        return seeds
+    for i, interval in batch.search_intervals(pieces, bwtMatcher):
+        j, start = owners[i]
+        seeds[j].append((start, start + length, interval))
+    return seeds
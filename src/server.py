@@ -0,0 +1,152 @@
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 4 << 30
+# Starts the line sent after the output of a job, "END" or "ERROR <message>"; output lines never hold it
+TRAILER = "\0"
+
+class IndexCache:
+    """
+    Keeps loaded indexes around, evicting the least recently used ones when
+    their total size (the size of their index files) exceeds maxBytes.
+    An entry is reloaded when its index file has been modified.
+    """
+    def __init__(self, load, maxBytes=DEFAULT_CACHE_SIZE):
+        self.load = load
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.totalBytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        The loaded index in filename
+
+        >>> cache = IndexCache(lambda filename: filename.upper(), maxBytes=0)
+        >>> cache.get(__file__) == __file__.upper()
+        True
+        """
+        stat = os.stat(filename)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == stat.st_mtime_ns:
+                self.entries.move_to_end(filename)
+                return entry[2]
+            if entry is not None:
+                self._remove(filename)
+            value = self.load(filename)
+            self.entries[filename] = (stat.st_mtime_ns, stat.st_size, value)
+            self.totalBytes += stat.st_size
+            # The entry just added is kept even if it alone is larger than maxBytes
+            while self.totalBytes > self.maxBytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+            return value
+
+    def _remove(self, filename):
+        _, size, _ = self.entries.pop(filename)
+        self.totalBytes -= size
+
+class _Handler(socketserver.StreamRequestHandler):
+    wbufsize = 1 << 16
+
+    def handle(self):
+        writer = _TextWriter(self.wfile)
+        try:
+            job = json.loads(self.rfile.readline())
+            self.server.runJob(job, writer, writer.start)
+        except Exception as e:
+            writer.fail(e)
+        else:
+            writer.finish()
+
+class _TextWriter:
+    """
+    Text stream over the connection that sends the status line before the
+    output and a trailer line after it, so the client can tell a complete
+    output from one cut short by an error
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.started = False
+        self.lineStart = True
+
+    def start(self):
+        self.raw.write(b"OK\n")
+        self.started = True
+
+    def finish(self):
+        self._trailer("END")
+
+    def fail(self, error):
+        if self.started:
+            self._trailer(f"ERROR {error}")
+        else:
+            self.raw.write(f"ERROR {error}\n".encode())
+
+    def _trailer(self, text):
+        # On a line of its own, even after a partly written line
+        self.raw.write(("" if self.lineStart else "\n").encode() + f"{TRAILER}{text}\n".encode())
+
+    def write(self, text):
+        if text:
+            self.raw.write(text.encode())
+            self.lineStart = text.endswith("\n")
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(socketPath, runJob):
+    """
+    Serves mapping jobs on a Unix socket until interrupted or terminated.
+    Every connection sends one job as a line of JSON; runJob(job, out, start)
+    writes the result to out after calling start(), and the client receives
+    "OK", the output and a TRAILER line "END", or "ERROR <message>" if the
+    job failed, in place of "OK" if it had not started yet. A socket left at socketPath by a previous server is
+    replaced, but FileExistsError is raised if anything else is there.
+    """
+    try:
+        if not stat.S_ISSOCK(os.lstat(socketPath).st_mode):
+            raise FileExistsError(f"{socketPath} exists and is not a socket")
+        os.unlink(socketPath)
+    except FileNotFoundError:
+        pass
+    with _Server(socketPath, _Handler) as server:
+        server.runJob = runJob
+        # SIGTERM unwinds like an interrupt, so the socket is removed either way
+        previous = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            os.unlink(socketPath)
+
+def submit(socketPath, job, out):
+    """
+    Sends a job to the server on socketPath and copies its output to out.
+    Raises RuntimeError with the server's message if the job failed, even
+    after part of the output was copied, or if the output ended early.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socketPath)
+        connection.sendall(json.dumps(job).encode() + b"\n")
+        with connection.makefile("r") as response:
+            status = response.readline().rstrip("\n")
+            if status != "OK":
+                raise RuntimeError(status.removeprefix("ERROR ") or "the server closed the connection")
+            for line in response:
+                if line.startswith(TRAILER):
+                    trailer = line[len(TRAILER):].rstrip("\n")
+                    if trailer != "END":
+                        raise RuntimeError(trailer.removeprefix("ERROR "))
+                    return
+                out.write(line)
+        raise RuntimeError("the server closed the connection before the end of the output")
@@ -0,0 +1,132 @@
+"""
+Phase timers and counters of an fm run, reported with fm --stats.
+
+Instrumented code uses `stats.current`, which does nothing until enable()
+is called, so the timers cost a couple of attribute lookups when off.
+"""
+import json
+import time
+from contextlib import nullcontext
+
+class Stats:
+    """
+    Wall clock time spent in every phase plus event counters. Phases nest,
+    and the time of an inner phase is not counted in the outer one, so the
+    phases add up to the time spent in any of them.
+
+    >>> stats = Stats()
+    >>> with stats.phase("outer"):
+    ...     with stats.phase("inner"):
+    ...         stats.count("events", 2)
+    >>> sorted(stats.phases), stats.counters
+    (['inner', 'outer'], {'events': 2})
+    """
+    enabled = True
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+        self.mark = 0.0
+        self.started = time.perf_counter()
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self._charge(now)
+        self.stack.append(name)
+        self.mark = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self._charge(now)
+        self.stack.pop()
+        self.mark = now
+
+    def _charge(self, now):
+        name = self.stack[-1]
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.mark
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def timed(self, iterable, name):
+        """
+        Iterates over iterable with the time spent producing every item counted in the phase name
+
+        >>> stats = Stats()
+        >>> list(stats.timed(range(3), "produce")), list(stats.phases)
+        ([0, 1, 2], ['produce'])
+        """
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, summary):
+        """
+        Adds the phases and counters of a summary, e.g. from a worker process
+        """
+        for name, seconds in summary["phases"].items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        for name, n in summary["counters"].items():
+            self.count(name, n)
+
+    def summary(self):
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "phases": dict(sorted(self.phases.items(), key=lambda x: -x[1])),
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def write(self, out):
+        json.dump(self.summary(), out, indent=1)
+        out.write("\n")
+
+class _Phase:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.stats.exit()
+
+class NullStats:
+    """
+    Stats that records nothing
+    """
+    enabled = False
+
+    def phase(self, name):
+        return nullcontext()
+
+    def timed(self, iterable, name):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, summary):
+        pass
+
+current = NullStats()
+
+def enable():
+    """
+    Starts recording into a new Stats, which becomes stats.current
+    """
+    global current
+    current = Stats()
+    return current
@@ -0,0 +1,495 @@
+import io
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import pytest
+import numpy as np
+import fm
+import rank
+import batch
+import bidirectional
+import seeds
+import approx
+import server
+import index
+import stats
+import generators
+import fasta, fastq
+import readers
+import gzip, bz2
+
+GENERATION_METHODS = [
+    generators.generate_random_sequence,
+    generators.generate_same_before,
+    generators.generate_multiple,
+    generators.generate_different,
+    generators.generate_fibonacci,
+]
+
+def random_strings(alphabet="acgt", n=5, minLength=0, maxLength=200):
+    random.seed(0)
+    for gen in GENERATION_METHODS:
+        for chain in generators.generate_chains(n, list(alphabet), gen, minLength, maxLength):
+            yield chain
+
+def test_sais_matches_radix():
+    for chain in random_strings():
+        x = memoryview((chain + "$").encode())
+        assert fm.sais_suffix_array(x) == fm.radix_suffix_array(x)
+    # Several records joined by SEPARATOR, which sorts before the sentinel byte
+    chains = list(random_strings(maxLength=30))
+    for i in range(0, len(chains) - 2, 3):
+        x = memoryview((fm.SEPARATOR.join(chains[i:i + 3]) + "$").encode())
+        assert fm.sais_suffix_array(x) == fm.radix_suffix_array(x)
+
+def test_search_matches_naive():
+    for chain in random_strings(maxLength=100):
+        bwtMatcher = fm.preprocess_genomes([["chr", chain]])[0]
+        for length in range(1, 5):
+            for start in range(0, max(len(chain) - length, 0), 7):
+                p = chain[start:start + length]
+                expected = [i - 1 for i in generators.findPattern(chain, p)]
+                assert sorted(fm.searchPattern(p, bwtMatcher)) == expected
+
+def test_rank_matches_naive():
+    random.seed(1)
+    codes = bytes(random.randrange(4) for _ in range(500))
+    for k in (1, 3, 64):
+        table = rank.RankTable(codes, 4, k)
+        for i in range(len(codes) + 1):
+            for c in range(4):
+                assert table.rank(c, i) == codes[:i].count(c)
+
+def test_packed_rank_matches_naive():
+    random.seed(2)
+    # Mostly four symbols, with runs of the other three as exceptions
+    codes = bytearray(random.randrange(2, 6) for _ in range(700))
+    for start in range(0, 650, 97):
+        length = random.randrange(1, 40)
+        codes[start:start + length] = bytes([random.choice((0, 1, 6))]) * length
+    codes = bytes(codes)
+    for k in (4, 64):
+        table = rank.PackedRankTable(codes, 7, k)
+        assert [table[i] for i in range(len(codes))] == list(codes)
+        positions = range(len(codes) + 1)
+        for c in range(7):
+            expected = [codes[:i].count(c) for i in positions]
+            assert [table.rank(c, i) for i in positions] == expected
+            assert table.rank_many(np.full(len(positions), c), np.array(positions)).tolist() == expected
+
+def test_protein_index_uses_wavelet_matrix(tmp_path):
+    random.seed(4)
+    for length in (50, 200):
+        chain = "".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(length))
+        fm.genomes_to_file(tmp_path / "protein.fa", [["prot", chain]], saSample=4)
+        bwtMatcher = fm.load_index(fm.index_filename(tmp_path / "protein.fa"))[0]
+        assert bwtMatcher.rank_table.KIND == "wavelet"
+        reads = [chain[i:i + 3] for i in range(0, len(chain), 11)]
+        found = dict(batch.search_intervals(reads, bwtMatcher))
+        for i, read in enumerate(reads):
+            expected = [j - 1 for j in generators.findPattern(chain, read)]
+            assert sorted(fm.searchPattern(read, bwtMatcher)) == expected
+            left, right = found[i]
+            assert sorted(fm.locate(bwtMatcher, row) for row in range(left, right)) == expected
+
+def test_sampled_locate():
+    for chain in random_strings(n=2, maxLength=100):
+        full = fm.preprocess_genomes([["chr", chain]])[0]
+        for s in (2, 5):
+            for mode in ("text", "row"):
+                sampled = fm.preprocess_genomes([["chr", chain]], saSample=s, saSampleMode=mode)[0]
+                for row in range(len(full.f)):
+                    assert fm.locate(sampled, row) == full.f.lookup(row)
+
+def test_index_roundtrip(tmp_path):
+    genomes = [["chr1", "mississippi"], ["chr2", ""], ["chr3", "acgtacgtttacg"]]
+    built = fm.genomes_to_file(tmp_path / "genome.fa", genomes, saSample=3)[0]
+    loaded = fm.load_index(fm.index_filename(tmp_path / "genome.fa"))[0]
+    assert loaded.alphadic == built.alphadic
+    assert loaded.names == built.names == ["chr1", "chr3"]
+    for _, chain in genomes:
+        for length in range(1, 4):
+            for start in range(len(chain) - length + 1):
+                p = chain[start:start + length]
+                assert sorted(fm.searchPattern(p, loaded)) == sorted(fm.searchPattern(p, built))
+
+def test_joined_records_report_local_positions():
+    genomes = [["chr1", "acgt"], ["chr2", "tacg"], ["chr3", "ttt"]]
+    bwtList = fm.preprocess_genomes(genomes)
+    hits = list(fm.map_reads([["read1", "acg"], ["read2", "tt"], ["read3", "gtt"]], bwtList))
+    assert sorted((h[0][1], h[1][1], h[2]) for h in hits) == [(1, 1, 1), (1, 2, 2), (2, 3, 1), (2, 3, 2)]
+
+def test_parsers_stream_records():
+    genomes = fasta.fasta_parse(io.StringIO(">chr1\nacg\ntt\n>chr2\n\n>chr3\na\n"))
+    assert next(genomes) == ["chr1", "acgtt"]
+    assert list(genomes) == [["chr2", ""], ["chr3", "a"]]
+    reads = fastq.fastq_parser(io.StringIO("@read1\nacg\n+\n@@@\n@read2\ntt\n"))
+    assert list(reads) == [["read1", "acg"], ["read2", "tt"]]
+
+def test_compressed_inputs(tmp_path):
+    text = "".join(f"@read{i}\n{'acgt' * (i % 50)}\n+\n{'I' * 4 * (i % 50)}\n" for i in range(3000))
+    data = text.encode()
+    (tmp_path / "reads.fq").write_bytes(data)
+    (tmp_path / "reads.fq.gz").write_bytes(gzip.compress(data))
+    (tmp_path / "reads.bz2").write_bytes(bz2.compress(data))
+    # bgzip output: blocks of at most 64 kB, then an empty block
+    blocks = [readers.bgzf_block(data[i:i + 10000]) for i in range(0, len(data), 10000)]
+    (tmp_path / "reads.fq.bgz").write_bytes(b"".join(blocks) + readers.bgzf_block(b""))
+    expected = list(fastq.fastq_parser(io.StringIO(text)))
+    for name, threads in [("reads.fq", 1), ("reads.fq.gz", 4), ("reads.bz2", 1), ("reads.fq.bgz", 1), ("reads.fq.bgz", 3)]:
+        with readers.open_text(tmp_path / name, threads) as file:
+            assert list(fastq.fastq_parser(file)) == expected, name
+    # Any gzip reader reads BGZF
+    assert gzip.decompress((tmp_path / "reads.fq.bgz").read_bytes()) == data
+
+    (tmp_path / "broken.bgz").write_bytes(b"".join(blocks)[:-5])
+    with readers.open_text(tmp_path / "broken.bgz", 2) as file:
+        with pytest.raises(ValueError):
+            file.read()
+
+def test_extract_from_index(tmp_path):
+    rng = random.Random(25)
+    genomes = [[f"chr{i}", "".join(rng.choice("acgtn") for _ in range(rng.randrange(1, 300)))] for i in range(4)]
+    for backend, saBuilder in [(backend, "sais") for backend in rank.RANK_TABLES] + [("auto", "radix")]:
+        built = fm.genomes_to_file(tmp_path / "genome.fa", genomes, rankBackend=backend, saSample=4, isaSample=16,
+                                   saBuilder=saBuilder)
+        loaded = fm.load_index(fm.index_filename(tmp_path / "genome.fa"))
+        for bwtList in (built, loaded):
+            for name, chain in genomes:
+                assert fm.extract(bwtList, name) == chain
+                for _ in range(10):
+                    start = rng.randrange(len(chain))
+                    end = rng.randrange(start, len(chain) + 1)
+                    assert fm.extract(bwtList, name, start, end) == chain[start:end]
+    with pytest.raises(ValueError):
+        fm.extract(loaded, "chr0", 0, len(genomes[0][1]) + 1)
+    with pytest.raises(ValueError):
+        fm.extract(loaded, "chrX")
+
+def test_sort_hits_spills_to_disk():
+    random.seed(2)
+    hits = [(("read", random.randrange(5)), ("chr", random.randrange(5)), random.randrange(100), 3, "acg",
+             random.choice("+-")) for _ in range(200)]
+    assert list(fm.sort_hits(iter(hits), bufferSize=16)) == sorted(hits, key=lambda x: (x[0], x[1], x[2], x[5]))
+
+def test_bidirectional_search_and_both_strands():
+    random.seed(7)
+    chain = "".join(random.choice("acgt") for _ in range(200))
+    bwtMatcher, = fm.preprocess_genomes([["chr1", chain]], reverseIndex=True)
+    for _ in range(30):
+        start = random.randrange(190)
+        p = chain[start:start + random.randrange(1, 10)]
+        interval = bidirectional.full_interval(bwtMatcher)
+        for a in p:
+            interval = bidirectional.extend_right(bwtMatcher, interval, bwtMatcher.alphadic[a])
+        assert interval == bidirectional.search(bwtMatcher, p)
+        assert interval[2] == sum(chain.startswith(p, i) for i in range(len(chain)))
+    read = bidirectional.reverse_complement(chain[50:70])
+    hits = list(fm.map_reads([["read1", read]], [bwtMatcher], {"bothStrands": True}))
+    assert ((("read", 1), ("chr", 1), 51, "20M", chain[50:70], "-") in hits
+            and all(hit[5] == "-" for hit in hits if hit[4] != read))
+
+def test_smems_and_fixed_seeds():
+    random.seed(8)
+    chain = "".join(random.choice("acgt") for _ in range(300))
+    bwtMatcher, = fm.preprocess_genomes([["chr1", chain]], reverseIndex=True)
+    for _ in range(30):
+        start = random.randrange(260)
+        p = "".join(a if random.random() > 0.1 else random.choice("acgtn") for a in chain[start:start + 40])
+        # Longest match starting at every position; the SMEMs are where it ends further than from the one before
+        ends = []
+        for s in range(len(p)):
+            e = s
+            while e < len(p) and p[s:e + 1] in chain:
+                e += 1
+            ends.append(e)
+        expected = [(s, e) for s, e in enumerate(ends) if e > s and (s == 0 or ends[s - 1] < e)]
+        found = seeds.smems(bwtMatcher, p)
+        assert [(s, e) for s, e, _ in found] == expected
+        assert all(right - left == sum(chain.startswith(p[s:e], i) for i in range(len(chain)))
+                   for s, e, (left, right) in found)
+    read = chain[100:130]
+    hits = list(fm.map_reads([["read1", read]], [bwtMatcher], {"seeds": {"mode": "fixed", "length": 10}}))
+    assert {(("chr", 1), 101, "10M20S"), (("chr", 1), 111, "10S10M10S"), (("chr", 1), 121, "20S10M")} <= \
+        {hit[1:4] for hit in hits}
+    with pytest.raises(ValueError):
+        seeds.Seeding("fixed", length=0)
+    with pytest.raises(ValueError):
+        seeds.Seeding(maxOccurrences=-1)
+
+def test_run_length_index(tmp_path):
+    random.seed(9)
+    base = "".join(random.choice("acgt") for _ in range(200))
+    strains = [[f"strain{i}", base[:50 * i] + random.choice("acgt") + base[50 * i + 1:]] for i in range(4)]
+    plain = fm.preprocess_genomes(strains)
+    runs = fm.genomes_to_file(tmp_path / "genome.fa", strains, rankBackend="runs", reverseIndex=True)
+    loaded = fm.load_index(fm.index_filename(tmp_path / "genome.fa"))
+    assert loaded[0].rank_table.runs < len(loaded[0].f) // 4
+    # No inverse suffix array samples unless asked for, which would take O(n) space
+    assert loaded[0].isa is None and loaded[0].build["isaSample"] == 0
+    with pytest.raises(ValueError):
+        fm.extract(loaded, "strain0", 0, 10)
+    reads = [[f"read{i}", base[i:i + 15]] for i in range(0, 180, 7)] + [["read99", "acgtx"]]
+    expected = sorted(fm.map_reads(reads, plain))
+    assert sorted(fm.map_reads(reads, runs)) == sorted(fm.map_reads(reads, loaded)) == expected
+    assert sorted(fm.map_reads(reads, loaded, {"edits": 1})) == sorted(fm.map_reads(reads, plain, {"edits": 1}))
+    assert sorted(fm.searchPattern(base[:10], loaded[0])) == sorted(fm.searchPattern(base[:10], plain[0]))
+    options = {"seeds": {"mode": "smem", "length": 8}}
+    assert sorted(fm.map_reads(reads, loaded, options)) == \
+        sorted(fm.map_reads(reads, fm.preprocess_genomes(strains, reverseIndex=True), options))
+
+def test_max_memory_builds_segments(tmp_path, capsys):
+    random.seed(10)
+    genomes = [[f"chr{i}", "".join(random.choice("acgt") for _ in range(100 * (i + 1)))] for i in range(5)]
+    reads = [[f"read{i}", gen[1][j:j + 12]] for i, gen in enumerate(genomes) for j in (0, 40, 88)]
+    expected = sorted(fm.map_reads(reads, fm.preprocess_genomes(genomes)))
+    maxMemory = fm.BUILD_BASELINE_BYTES + 300 * fm.BUILD_BYTES_PER_BASE
+    bwtList = fm.genomes_to_file(tmp_path / "genome.fa", iter(genomes), maxMemory=maxMemory, kmerLength=2)
+    assert [bwtMatcher.names for bwtMatcher in bwtList] == [["chr0", "chr1"], ["chr2"], ["chr3"], ["chr4"]]
+    # chr3 and chr4 are over the budget on their own
+    warnings = capsys.readouterr().err.splitlines()
+    assert [line.split()[3] for line in warnings] == ["chr3", "chr4"]
+    assert sorted(fm.map_reads(reads, bwtList)) == expected
+    bwtList = fm.update_genomes_file(tmp_path / "genome.fa", genomes + [["chr5", "acgtacgt"]], maxMemory=maxMemory)
+    assert sorted(fm.map_reads(reads, bwtList)) == expected
+
+def test_count_interval_and_capped_reports():
+    genomes = [["chr1", "mississippi"], ["chr2", "ississippim"]]
+    bwtList = fm.preprocess_genomes(genomes, jobs=2)
+    runs = fm.preprocess_genomes(genomes, rankBackend="runs")
+    reads = [["read1", "ssi"], ["read2", "x"], ["read3", "i"]]
+    hits = list(fm.map_reads(reads, bwtList))
+    counts = list(fm.map_reads(reads, bwtList, {"report": "count"}))
+    assert [(name, count) for name, _, count, _ in counts] == [(("read", 1), 4), (("read", 2), 0), (("read", 3), 8)]
+    assert sum(right - left for _, _, _, spans in counts for _, left, right in spans) == len(hits)
+    for matchers in (bwtList, runs):
+        capped = list(fm.map_reads(reads, matchers, {"maxHits": 3}))
+        assert [hit[0][1] for hit in capped] == [1, 1, 1, 3, 3, 3]
+        assert set(capped) <= set(fm.map_reads(reads, matchers))
+
+def test_duplicate_reads_and_suffix_memo():
+    random.seed(6)
+    chain = "".join(random.choice("acgt") for _ in range(300))
+    bwtList = fm.preprocess_genomes([["chr1", chain], ["chr2", chain[::-1]]], jobs=2)
+    sequences = [chain[i:i + 12] for i in range(0, 280, 13)] + ["acgtacgtacgt", "acgtx"]
+    reads = [[f"read{i}", random.choice(sequences)] for i in range(100)]
+    expected = [hit for r in reads for hit in fm.map_reads([r], bwtList)]
+    assert list(fm.map_reads(reads, bwtList, {"batchSize": 30})) == expected
+    memos = fm.suffix_memos(bwtList, memoSize=8, memoLength=5)
+    assert list(fm.map_reads(reads, bwtList, {"batchSize": 7}, memos)) == expected
+    assert all(len(memo.entries) == 8 for memo in memos)
+    with pytest.raises(ValueError):
+        fm.suffix_memos(bwtList, memoSize=8, memoLength=0)
+
+def test_stats_file_is_not_taken_from_the_positionals(tmp_path):
+    genome = tmp_path / "genome.fa"
+    genome.write_text(">chr1\nacgt\n")
+    reads = tmp_path / "reads.fq"
+    reads.write_text("@read1\nacg\n+\nIII\n")
+    # --stats takes genome.fa as its FILE, which leaves no reads
+    result = subprocess.run([sys.executable, fm.__file__, "--stats", str(genome), str(reads)], capture_output=True)
+    assert result.returncode != 0
+    assert genome.read_text() == ">chr1\nacgt\n"
+
+def test_stats_count_the_work_done():
+    bwtList = fm.preprocess_genomes([["chr1", "mississippi"]])
+    reads = [["read1", "ssi"], ["read2", "ssi"], ["read3", "x"]]
+    try:
+        collected = stats.enable()
+        out = io.StringIO()
+        fm.write_hits(fm.sort_hits(fm.map_reads(reads, bwtList)), out)
+    finally:
+        stats.current = stats.NullStats()
+    assert len(out.getvalue().splitlines()) == 4
+    assert {"search", "locate", "sort", "output"} <= set(collected.phases)
+    counters = collected.counters
+    assert (counters["reads"], counters["distinct_reads"], counters["hits"], counters["hits_located"]) == (3, 2, 4, 2)
+    assert counters["rank_lookups"] > 0
+
+def test_parallel_mapping_keeps_read_order(tmp_path):
+    genomes = [["chr1", "mississippi"], ["chr2", "ississippim"]]
+    bwtList = fm.genomes_to_file(tmp_path / "genome.fa", genomes)
+    reads = [[f"read{i}", p] for i, p in enumerate(["iss", "ssi", "m", "x", "pp", "i"] * 3)]
+    expected = list(fm.map_reads(reads, bwtList))
+    parallel = fm.map_reads_parallel(reads, fm.index_filename(tmp_path / "genome.fa"), 2, {"batchSize": 4})
+    assert list(parallel) == expected
+    # The processes take every option from the same dict
+    for options in ({"batchSize": 4, "memoSize": 4, "maxHits": 1}, {"batchSize": 5, "report": "count"}):
+        parallel = fm.map_reads_parallel(reads, fm.index_filename(tmp_path / "genome.fa"), 2, options)
+        assert list(parallel) == list(fm.map_reads(reads, bwtList, options))
+
+def test_batch_search_matches_search_pattern():
+    for chain in random_strings(n=2, maxLength=150):
+        bwtMatcher = fm.preprocess_genomes([["chr", chain]], rankSample=8)[0]
+        random.seed(3)
+        reads = [chain[i:i + random.randrange(1, 12)] for i in range(0, len(chain), 5)] + ["", "x", chain + "a"]
+        found = dict(batch.search_intervals(reads, bwtMatcher))
+        for i, read in enumerate(reads):
+            left, right = found.get(i, (0, 0))
+            expected = sorted(fm.searchPattern(read, bwtMatcher))
+            assert sorted(fm.locate(bwtMatcher, row) for row in range(left, right)) == expected
+
+def test_kmer_table_gives_same_hits():
+    for chain in random_strings(n=2, maxLength=150):
+        plain = fm.preprocess_genomes([["chr1", chain], ["chr2", chain[::-1]]])[0]
+        for k in (1, 3):
+            bwtMatcher = fm.preprocess_genomes([["chr1", chain], ["chr2", chain[::-1]]], kmerLength=k)[0]
+            reads = [chain[i:i + length] for i in range(0, len(chain), 9) for length in (2, 3, 7)] + ["x" * 5]
+            found = dict(batch.search_intervals(reads, bwtMatcher))
+            for i, read in enumerate(reads):
+                expected = sorted(fm.searchPattern(read, plain))
+                assert sorted(fm.searchPattern(read, bwtMatcher)) == expected
+                assert found.get(i, (0, 0)) == dict(batch.search_intervals([read], plain)).get(0, (0, 0))
+    # A genome without letters gets no table
+    empty = fm.preprocess_genomes([["chr1", ""], ["chr2", ""]], kmerLength=3)
+    assert empty[0].kmers is None and list(fm.map_reads([["read1", "acg"]], empty)) == []
+
+def brute_force_alignments(text, p, d):
+    """
+    Every (position, cigar) aligning p to text with at most d edits, with the
+    same rules as approx.approximate_search
+    """
+    out = set()
+    def align(position, t, i, z, ops):
+        if i == len(p):
+            if ops.endswith("M"):
+                out.add((position, approx.cigar(ops)))
+            return
+        if t < len(text) and (text[t] == p[i] or z > 0):
+            align(position, t + 1, i + 1, z - (text[t] != p[i]), ops + "M")
+        if z > 0 and ops:
+            if not ops.endswith("D") and i < len(p) - 1:
+                align(position, t, i + 1, z - 1, ops + "I")
+            if not ops.endswith("I") and t < len(text):
+                align(position, t + 1, i, z - 1, ops + "D")
+    for position in range(len(text)):
+        align(position, position, 0, d, "")
+    return out
+
+def test_approximate_search_matches_brute_force():
+    random.seed(5)
+    for _ in range(60):
+        text = "".join(random.choice("acg") for _ in range(random.randint(1, 30)))
+        for reverseIndex in (False, True):
+            bwtMatcher = fm.preprocess_genomes([["chr1", text]], reverseIndex=reverseIndex)[0]
+            letters = list(fm.getLetters(bwtMatcher.alphadic))
+            p = "".join(random.choice("acg") for _ in range(random.randint(1, 6)))
+            d = random.randint(0, 2)
+            found = {(fm.locate(bwtMatcher, row), cigar)
+                     for left, right, cigar in approx.approximate_search(p, bwtMatcher, d, letters)
+                     for row in range(left, right)}
+            assert found == brute_force_alignments(text, p, d)
+
+def test_index_cache_evicts_least_recently_used(tmp_path):
+    files = []
+    for name in ("a", "b", "c"):
+        (tmp_path / name).write_bytes(b"x" * 10)
+        files.append(str(tmp_path / name))
+    loads = []
+    cache = server.IndexCache(lambda filename: loads.append(filename) or filename, maxBytes=20)
+    cache.get(files[0])
+    cache.get(files[1])
+    cache.get(files[0])
+    cache.get(files[2])
+    assert list(cache.entries) == [files[0], files[2]]
+    cache.get(files[0])
+    assert loads == [files[0], files[1], files[2]]
+
+def test_server_socket_handling(tmp_path):
+    reads = tmp_path / "reads.fq"
+    reads.write_text("@read1\nacgt\n")
+    with pytest.raises(FileExistsError):
+        server.serve(str(reads), None)
+    assert reads.read_text() == "@read1\nacgt\n"
+
+    socketPath = tmp_path / "fm.sock"
+    process = subprocess.Popen([sys.executable, fm.__file__, "--serve", str(socketPath)])
+    try:
+        for _ in range(100):
+            if socketPath.exists():
+                break
+            time.sleep(0.05)
+        assert socketPath.exists()
+
+        genome = tmp_path / "genome.fa"
+        genome.write_text(">chr1\nacgtt\n")
+        reads.write_text("@read1\nacg\n+\nIII\n@readx\nacg\n+\nIII\n")
+        job = {"genome": str(genome), "reads": str(reads), "options": {"unsorted": True}}
+        out = io.StringIO()
+        # readx has no number, which fails after read1 is written
+        with pytest.raises(RuntimeError):
+            server.submit(str(socketPath), job, out)
+        assert out.getvalue().splitlines() == ["read1\tchr1\t1\t3M\tacg"]
+        reads.write_text("@read1\nacg\n+\nIII\n@read2\nacg\n+\nIII\n")
+        out = io.StringIO()
+        server.submit(str(socketPath), job, out)
+        assert len(out.getvalue().splitlines()) == 2
+        with pytest.raises(RuntimeError, match="only applies to exact hits"):
+            server.submit(str(socketPath), dict(job, options={"edits": 1, "report": "count"}), io.StringIO())
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=10)
+    assert not socketPath.exists()
+
+def test_stale_index_is_rebuilt(tmp_path):
+    genome = tmp_path / "genome.fa"
+    genome.write_text(">chr1\nacgt\n>chr2\ntt\n")
+    indexFile = fm.ensure_index(genome)
+    assert fm.index_is_fresh(genome)
+    meta = index.read_metadata(indexFile)
+    assert [r["names"] for r in meta["records"]] == [["chr1", "chr2"]]
+    assert [r["lengths"] for r in meta["records"]] == [[4, 2]]
+
+    genome.write_text(">chr1\nacgt\n>chr2\nttt\n")
+    os.utime(genome, ns=(0, 0))
+    assert not fm.index_is_fresh(genome)
+    fm.ensure_index(genome)
+    assert index.read_metadata(indexFile)["records"][0]["lengths"] == [4, 3]
+
+def test_incremental_update_rebuilds_only_changed_parts(tmp_path):
+    genome = tmp_path / "genome.fa"
+    records = [["chr1", "acgtacgt"], ["chr2", "ttgacc"], ["chr3", "gggacgt"], ["chr4", "catcat"]]
+    fm.genomes_to_file(genome, records, jobs=2)
+    assert [m.names for m in fm.load_index(fm.index_filename(genome))] == [["chr1", "chr2"], ["chr3", "chr4"]]
+
+    records[3][1] = "cattac"
+    records.append(["chr5", "acgtt"])
+    built = []
+    original = fm.build_matchers
+    fm.build_matchers = lambda remaining, jobs=1, **options: built.append(remaining) or original(remaining, jobs, **options)
+    try:
+        fm.update_genomes_file(genome, records)
+    finally:
+        fm.build_matchers = original
+    assert [[gen[0] for gen in remaining] for remaining in built] == [["chr3", "chr4", "chr5"]]
+
+    bwtList = fm.load_index(fm.index_filename(genome))
+    assert [m.names for m in bwtList] == [["chr1", "chr2"], ["chr3", "chr4", "chr5"]]
+    hits = sorted((h[1][1], h[2]) for h in fm.map_reads([["read1", "acgt"], ["read2", "tac"]], bwtList))
+    assert hits == [(1, 1), (1, 4), (1, 5), (3, 4), (4, 4), (5, 1)]
+
+    # Different build options rebuild every part, even the unchanged ones
+    bwtList = fm.update_genomes_file(genome, records, reverseIndex=True, rankSample=16, rankBackend="wavelet")
+    for bwtMatcher in fm.load_index(fm.index_filename(genome)):
+        assert bwtMatcher.reverse_rank_table is not None
+        assert (bwtMatcher.rank_table.KIND, bwtMatcher.rank_table.k) == ("wavelet", 16)
+        assert bwtMatcher.build == fm.build_parameters({"reverseIndex": True, "rankSample": 16, "rankBackend": "wavelet"})
+
+    # With maxMemory the rebuilt records are streamed into segments, which keep their place among the copied ones
+    maxMemory = fm.BUILD_BASELINE_BYTES + 12 * fm.BUILD_BYTES_PER_BASE
+    records[1][1] = "ttgacca"
+    fm.update_genomes_file(genome, iter(records), maxMemory=maxMemory)
+    assert [m.names for m in fm.load_index(fm.index_filename(genome))] == [["chr1"], ["chr2"], ["chr3"], ["chr4", "chr5"]]
+    records[2][1] = "gggacgc"
+    original = fm.build_segments
+    fm.build_segments = lambda remaining, *args, **options: built.append(remaining) or original(remaining, *args, **options)
+    try:
+        bwtList = fm.update_genomes_file(genome, iter(records), maxMemory=maxMemory)
+    finally:
+        fm.build_segments = original
+    assert not isinstance(built[-1], list)
+    assert [m.names for m in bwtList] == [["chr1"], ["chr2"], ["chr3"], ["chr4", "chr5"]]
+    assert [m.hashes[0] for m in bwtList[2:3]] == [fm.record_hash("gggacgc")]